@@ -0,0 +1,133 @@
+#
+# bench_parsers.py: offline throughput and memory benchmark of the response parsers
+#
+# author: Paulo Monteiro
+# version: 0.1
+#
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from newrelic_query_api import NewRelicQueryAPI, prepare_response, parse_rows
+from fixtures import SHAPES, SINGLE_ROW_SHAPES, get_fixture
+
+SCALES = [10, 100, 1000, 10000, 100000]
+INCLUDE = {'account_id': 1, 'account_name': 'benchmark'}
+
+
+class OfflineQueryAPI(NewRelicQueryAPI):
+    """ NewRelicQueryAPI answering every query with a fixture response """
+
+    def __init__(self, response):
+        """init"""
+        super().__init__(account_id=1, query_api_key='offline')
+        self.__response = response
+
+    def query(self, nrql, params={}, max_retries=0, windows=1):
+        """returns the fixture response"""
+        return self.__response
+
+
+def consume_events(response):
+    """events() through the query client, as do_query and export_events see it"""
+    return sum(1 for _ in OfflineQueryAPI(response).events('', include=INCLUDE))
+
+
+def consume_fetch_data(response):
+    """the get_* function selected by the response plan alone"""
+    prepared = prepare_response(response, INCLUDE)
+    if not prepared:
+        return 0
+    plan, arguments = prepared
+    return sum(1 for _ in plan.fetch_data(*arguments, plans=plan.plans))
+
+
+def consume_rows(response):
+    """parse_rows, header plus row tuples as the storages consume them"""
+    return sum(1 for _ in parse_rows(response, INCLUDE))
+
+
+def measure(function, response, repeat):
+    """returns (rows, best seconds, peak bytes) of function(response)"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = function(response)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    function(response)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return rows, best, peak
+
+
+def get_target(function, response):
+    """names the get_* function a fetch_data measure runs"""
+    if function is consume_fetch_data:
+        prepared = prepare_response(response)
+        return prepared[0].fetch_data.__name__ if prepared else '-'
+    return function.__name__.replace('consume_', '')
+
+
+def run(shapes, scales, repeat, recorded):
+    """runs every shape x scale x function and returns the results list"""
+    results = []
+    for shape in shapes:
+        for scale in scales if not shape in SINGLE_ROW_SHAPES else scales[:1]:
+            response = get_fixture(shape, scale, recorded)
+            for function in [consume_events, consume_fetch_data, consume_rows]:
+                rows, seconds, peak = measure(function, response, repeat)
+                result = {
+                    'shape': shape,
+                    'scale': scale,
+                    'target': get_target(function, response),
+                    'rows': rows,
+                    'rows_per_sec': rows / seconds if seconds else 0,
+                    'peak_kb': peak / 1024
+                }
+                results.append(result)
+                print(f'{shape:28} {scale:>7} {result["target"]:24} {rows:>8} rows {result["rows_per_sec"]:>12.0f} rows/s {result["peak_kb"]:>10.1f} KB peak')
+    return results
+
+
+def compare(results, baseline_file, tolerance):
+    """prints the measures slower than the baseline by more than tolerance, returns how many"""
+    with open(baseline_file) as f:
+        baseline = {(r['shape'], r['scale'], r['target']): r for r in json.load(f)}
+    regressions = 0
+    for result in results:
+        previous = baseline.get((result['shape'], result['scale'], result['target']), None)
+        if not previous or not previous['rows_per_sec']:
+            continue
+        change = result['rows_per_sec'] / previous['rows_per_sec'] - 1
+        if change < -tolerance:
+            regressions += 1
+            print(f'regression: {result["shape"]} {result["scale"]} {result["target"]} {change:+.1%} rows/s')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='offline benchmark of the Query API response parsers')
+    parser.add_argument('--shapes', nargs='+', default=list(SHAPES), choices=list(SHAPES), help='response shapes')
+    parser.add_argument('--scales', nargs='+', type=int, default=SCALES, help='rows per response')
+    parser.add_argument('--repeat', type=int, default=3, help='best of repeat runs')
+    parser.add_argument('--recorded', action='store_true', help='scale responses recorded by record_fixtures.py when available')
+    parser.add_argument('--save', default='', help='save the results to a JSON baseline file')
+    parser.add_argument('--compare', default='', help='compare the results with a JSON baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed rows/s drop before flagging a regression')
+    args = parser.parse_args()
+
+    results = run(args.shapes, sorted(args.scales), args.repeat, args.recorded)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
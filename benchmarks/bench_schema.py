@@ -0,0 +1,82 @@
+#
+# bench_schema.py: schema discovery benchmark for wide SELECT * results
+#
+# author: Paulo Monteiro
+# version: 0.1
+#
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from newrelic_query_api import get_results_header, parse_rows
+from schema_registry import SchemaRegistry
+
+
+def legacy_results_header(contents, results):
+    """the list based (quadratic) header discovery replaced by get_results_header"""
+    header = []
+    for result in results:
+        for event in result['events']:
+            for key in event:
+                if not key in header:
+                    header.append(key)
+    return header
+
+
+def make_response(total_attributes=250, total_events=1000, seed=42):
+    """a SELECT * response where every event carries a random subset of the attributes"""
+    rand = random.Random(seed)
+    attributes = [f'attribute{i:03}' for i in range(total_attributes)]
+    events = []
+    for i in range(total_events):
+        keys = rand.sample(attributes, rand.randint(total_attributes // 2, total_attributes))
+        events.append({k:rand.random() for k in keys})
+    return {
+        'metadata': {
+            'contents': [{'function': 'events', 'limit': total_events, 'order': {'column': 'timestamp', 'descending': True}}],
+            'beginTimeMillis': 0,
+            'endTimeMillis': 3600000
+        },
+        'results': [{'events': events}]
+    }
+
+
+def timeit(function, repeat=5):
+    """best wall time of repeat runs"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == '__main__':
+    total_attributes = int(sys.argv[1]) if len(sys.argv) > 1 else 250
+    total_events = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    response = make_response(total_attributes, total_events)
+    contents = response['metadata']['contents']
+    results = response['results']
+    assert legacy_results_header(contents, results) == get_results_header(contents, results)
+
+    legacy = timeit(lambda: legacy_results_header(contents, results))
+    current = timeit(lambda: get_results_header(contents, results))
+    print(f'{total_attributes} attributes x {total_events} events')
+    print(f'header discovery  legacy {legacy*1000:9.2f} ms  ordered set {current*1000:9.2f} ms  speedup {legacy/current:6.1f}x')
+
+    def align_all():
+        registry = SchemaRegistry()
+        for account_id in range(10):
+            rows = parse_rows(response, {'account_id': account_id})
+            schema = registry.get_schema('events', rows.header)
+            align = schema.get_aligner(rows.header)
+            for row in rows:
+                align(row)
+
+    elapsed = timeit(align_all, repeat=1)
+    print(f'parse + align 10 accounts {elapsed*1000:9.2f} ms  {10*total_events/elapsed:12.0f} rows/s')
@@ -0,0 +1,111 @@
+#
+# bench_startup.py: startup and import time benchmark of the insights-cli commands
+#
+# author: Paulo Monteiro
+# version: 0.1
+#
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_insights_server import start_server
+
+PACKAGE_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI_FILE = os.path.join(PACKAGE_FOLDER, 'insights-cli.py')
+COMMANDS = ['query', 'merge-local', 'batch-local', 'batch-parquet', 'batch-sqlite', 'batch-google', 'batch-insights', 'replay-insights']
+# dependencies only some commands need, reported when the query command loads them
+HEAVY_MODULES = ['googleapiclient', 'oauth2client', 'pyarrow', 'yaml', 'sqlite3']
+QUERY = 'SELECT count(*) FROM Transaction SINCE 1 day ago'
+
+
+def timeit(args, repeat=10, env=None):
+    """best wall time in seconds of repeat runs of a command line"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def get_import_times(args):
+    """returns {module: (cumulative us, depth)} of the modules imported by a command line, see python -X importtime"""
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    modules = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        # nested imports are indented 2 more spaces per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules[name.strip()] = (int(cumulative_us), depth)
+    return modules
+
+
+def run(commands, repeat):
+    """times the interpreter, every command -h and a query against the mock server"""
+    results = [{'command': 'python', 'ms': timeit([sys.executable, '-c', 'pass'], repeat) * 1000}]
+    for command in commands:
+        results.append({'command': command + ' -h', 'ms': timeit([sys.executable, CLI_FILE, command, '-h'], repeat) * 1000})
+    server = start_server(latency=0.0, rows=10)
+    env = dict(os.environ, NEW_RELIC_QUERY_API_URL=server.get_url())
+    query = [sys.executable, CLI_FILE, 'query', '-a', '1', '-k', 'key', '-o', os.devnull, '-q', QUERY]
+    results.append({'command': 'query', 'ms': timeit(query, repeat, env) * 1000})
+    server.shutdown()
+    for result in results:
+        print(f'{result["command"]:24} {result["ms"]:8.1f} ms')
+    return results
+
+
+def report_imports(top):
+    """prints the slowest top level imports of the query command and the heavy modules it loads"""
+    modules = get_import_times([CLI_FILE, 'query', '-h'])
+    top_level = sorted([(cumulative_us, k) for k,(cumulative_us, depth) in modules.items() if depth == 0], reverse=True)
+    print(f'query -h imports {len(modules)} modules, slowest top level imports:')
+    for cumulative_us, name in top_level[:top]:
+        print(f'  {name:32} {cumulative_us / 1000:8.1f} ms')
+    heavy = sorted(set(name.split('.')[0] for name in modules if name.split('.')[0] in HEAVY_MODULES))
+    print(f'heavy modules loaded by query: {", ".join(heavy) if heavy else "none"}')
+
+
+def compare(results, baseline_file, tolerance):
+    """prints the measures slower than the baseline by more than tolerance, returns how many"""
+    with open(baseline_file) as f:
+        baseline = {r['command']: r for r in json.load(f)}
+    regressions = 0
+    for result in results:
+        previous = baseline.get(result['command'], None)
+        if not previous or not previous['ms']:
+            continue
+        change = result['ms'] / previous['ms'] - 1
+        if change > tolerance:
+            regressions += 1
+            print(f'regression: {result["command"]} {change:+.1%} ms')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='startup and import time benchmark of the insights-cli commands')
+    parser.add_argument('--commands', nargs='+', default=COMMANDS, choices=COMMANDS, help='commands timed with -h')
+    parser.add_argument('--repeat', type=int, default=10, help='best of repeat runs')
+    parser.add_argument('--top', type=int, default=10, help='slowest top level imports listed')
+    parser.add_argument('--save', default='', help='save the results to a JSON baseline file')
+    parser.add_argument('--compare', default='', help='compare the results with a JSON baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed startup time growth before flagging a regression')
+    args = parser.parse_args()
+
+    results = run(args.commands, args.repeat)
+    report_imports(args.top)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
@@ -0,0 +1,245 @@
+#
+# fixtures.py: Insights Query API payloads for offline benchmarks and load tests
+#
+# author: Paulo Monteiro
+# version: 0.1
+#
+
+import copy
+import json
+import os
+
+FIXTURES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+BEGIN_TIME = 1600000000
+BUCKET_SIZE = 60
+BUCKETS_PER_FACET = 60
+EVENT_STAR_ATTRIBUTES = 40
+
+AGGREGATES = [
+    {'function': 'percentage', 'attribute': '', 'simple': True},
+    {'function': 'funnel', 'attribute': 'traceId', 'steps': ['duration < 2', 'duration < 1']},
+    {'function': 'apdex', 'attribute': 'duration'},
+    {'function': 'uniqueCount', 'attribute': 'appId', 'simple': True},
+    {'function': 'count', 'attribute': '', 'simple': True},
+    {'function': 'min', 'attribute': 'duration', 'simple': True},
+    {'function': 'max', 'attribute': 'duration', 'simple': True},
+    {'function': 'latest', 'attribute': 'duration', 'simple': True},
+    {'function': 'sum', 'attribute': 'duration', 'simple': True},
+    {'function': 'average', 'attribute': 'duration', 'simple': True},
+    {'function': 'stddev', 'attribute': 'duration', 'simple': True},
+    {'function': 'percentile', 'attribute': 'duration', 'thresholds': [50, 75, 90]},
+    {'function': 'histogram', 'attribute': 'duration', 'start': 0, 'bucketSize': 0.5, 'bucketCount': 4},
+    {'function': 'rate', 'attribute': '', 'of': {'function': 'uniqueCount', 'attribute': 'appId'}},
+]
+
+
+def get_contents(alias=False):
+    """aggregate functions metadata as in queries-samples.yaml, optionally aliased"""
+    if not alias:
+        return copy.deepcopy(AGGREGATES)
+    return [{'alias': 'My' + content['function'].capitalize(), 'contents': copy.deepcopy(content)} for content in AGGREGATES]
+
+
+def get_results(seed=1):
+    """one results list matching AGGREGATES"""
+    return [
+        {'result': 12.5 * seed},
+        {'steps': [100 * seed, 50 * seed]},
+        {'score': 0.93, 's': 90 * seed, 't': 5 * seed, 'f': 5 * seed, 'count': 100 * seed},
+        {'uniqueCount': 3 * seed},
+        {'count': 100 * seed},
+        {'min': 0.001 * seed},
+        {'max': 2.5 * seed},
+        {'latest': 0.2 * seed},
+        {'sum': 31.4 * seed},
+        {'average': 0.314 * seed},
+        {'stddev': 0.05 * seed},
+        {'percentiles': {'50': 0.2 * seed, '75': 0.4 * seed, '90': 0.9 * seed}},
+        {'histogram': [40 * seed, 30 * seed, 20 * seed, 10 * seed]},
+        {'result': 0.5 * seed},
+    ]
+
+
+def get_timeseries(buckets, seed=1):
+    """a timeSeries list of buckets"""
+    return [{
+        'beginTimeSeconds': BEGIN_TIME + i * BUCKET_SIZE,
+        'endTimeSeconds': BEGIN_TIME + (i + 1) * BUCKET_SIZE,
+        'inspectedCount': 100 * seed + i,
+        'results': get_results(seed + i % 7)
+    } for i in range(buckets)]
+
+
+def get_facets(facets, buckets=0):
+    """a facets list, with timeseries buckets when buckets > 0"""
+    facets_list = []
+    for i in range(facets):
+        facet = {'name': [f'app{i}', str(1000 + i)]}
+        if buckets:
+            facet['timeSeries'] = get_timeseries(buckets, i % 5 + 1)
+        else:
+            facet['results'] = get_results(i % 5 + 1)
+        facets_list.append(facet)
+    return facets_list
+
+
+def get_metadata(contents, **kwargs):
+    """metadata common attributes"""
+    metadata = {
+        'beginTimeMillis': BEGIN_TIME * 1000,
+        'endTimeMillis': (BEGIN_TIME + 86400) * 1000,
+        'contents': contents
+    }
+    metadata.update(kwargs)
+    return metadata
+
+
+def event_types(rows):
+    names = [f'EventType{i}' for i in range(min(rows, 1000))]
+    return {'metadata': get_metadata([{'function': 'eventTypes'}]), 'results': [{'eventTypes': names}]}
+
+
+def event_keyset(rows):
+    keys = [f'attribute{i}' for i in range(min(rows, 1000))]
+    return {'metadata': get_metadata([{'function': 'keyset'}]), 'results': [{'allKeys': keys}]}
+
+
+def get_events(rows, attributes):
+    """an events result with attributes per event"""
+    contents = [{'function': 'events', 'limit': rows, 'order': {'column': 'timestamp', 'descending': True}}]
+    events = [{
+        'timestamp': (BEGIN_TIME + i) * 1000,
+        'appName': f'app{i % 10}',
+        'appId': 1000 + i % 10,
+        **{f'attribute{k}': i * k * 0.5 for k in range(attributes - 3)}
+    } for i in range(rows)]
+    return {'metadata': get_metadata(contents), 'results': [{'events': events}]}
+
+
+def event_star(rows):
+    return get_events(rows, EVENT_STAR_ATTRIBUTES)
+
+
+def event_list(rows):
+    return get_events(rows, 3)
+
+
+def event_single(rows, alias=False):
+    return {'metadata': get_metadata(get_contents(alias)), 'results': get_results()}
+
+
+def timeseries(rows, alias=False):
+    metadata = get_metadata({}, timeSeries={'contents': get_contents(alias)})
+    return {'metadata': metadata, 'timeSeries': get_timeseries(rows)}
+
+
+def faceted(rows, alias=False):
+    metadata = get_metadata({'contents': get_contents(alias)}, facet=['appName', 'appId'])
+    return {'metadata': metadata, 'facets': get_facets(rows)}
+
+
+def faceted_timeseries(rows, alias=False):
+    buckets = min(rows, BUCKETS_PER_FACET)
+    metadata = get_metadata({'timeSeries': {'contents': get_contents(alias)}}, facet=['appName', 'appId'])
+    return {'metadata': metadata, 'facets': get_facets(max(1, rows // buckets), buckets)}
+
+
+def compared(rows, alias=False):
+    metadata = get_metadata({'contents': get_contents(alias)}, compareWith=604800000)
+    return {'metadata': metadata, 'current': {'results': get_results(1)}, 'previous': {'results': get_results(2)}}
+
+
+def compared_faceted(rows, alias=False):
+    contents = {'facet': ['appName', 'appId'], 'contents': {'contents': get_contents(alias)}}
+    metadata = get_metadata(contents, compareWith=604800000)
+    return {'metadata': metadata, 'current': {'facets': get_facets(rows)}, 'previous': {'facets': get_facets(rows)}}
+
+
+def compared_timeseries(rows, alias=False):
+    contents = {'timeSeries': {'contents': get_contents(alias)}}
+    metadata = get_metadata(contents, compareWith=604800000)
+    return {'metadata': metadata, 'current': {'timeSeries': get_timeseries(rows)}, 'previous': {'timeSeries': get_timeseries(rows, 2)}}
+
+
+# one generator per query in queries-samples.yaml
+SHAPES = {
+    'event_types': event_types,
+    'event_keyset': event_keyset,
+    'event_star': event_star,
+    'event_list': event_list,
+    'event_single': event_single,
+    'event_single_alias': lambda rows: event_single(rows, True),
+    'timeseries': timeseries,
+    'timeseries_alias': lambda rows: timeseries(rows, True),
+    'faceted': faceted,
+    'faceted_alias': lambda rows: faceted(rows, True),
+    'faceted_timeseries': faceted_timeseries,
+    'faceted_timeseries_alias': lambda rows: faceted_timeseries(rows, True),
+    'compared': compared,
+    'compared_alias': lambda rows: compared(rows, True),
+    'compared_faceted': compared_faceted,
+    'compared_faceted_alias': lambda rows: compared_faceted(rows, True),
+    'compared_timeseries': compared_timeseries,
+    'compared_timeseries_alias': lambda rows: compared_timeseries(rows, True),
+    'parameters': compared,
+}
+
+# shapes that always produce a single row whatever the scale
+SINGLE_ROW_SHAPES = ['event_types', 'event_keyset', 'event_single', 'event_single_alias', 'compared', 'compared_alias', 'parameters']
+
+
+def scale_list(items, rows, rename=None):
+    """cycles items up to rows elements, rename(item, i) keeps copies distinguishable"""
+    if not items:
+        return items
+    scaled = []
+    for i in range(rows):
+        item = items[i % len(items)]
+        scaled.append(rename(item, i // len(items)) if rename and i >= len(items) else item)
+    return scaled
+
+
+def scale_response(response, rows):
+    """scales a recorded response to about rows rows by cycling its events, facets or buckets"""
+    def rename_facet(facet, copy_index):
+        name = facet['name']
+        name = [f'{v}#{copy_index}' for v in name] if type(name) is list else f'{name}#{copy_index}'
+        return {**facet, 'name': name}
+
+    def scale_timeseries(buckets):
+        span = buckets[-1]['endTimeSeconds'] - buckets[0]['beginTimeSeconds'] if buckets else 0
+        def shift_bucket(bucket, copy_index):
+            return {**bucket, 'beginTimeSeconds': bucket['beginTimeSeconds'] + copy_index * span, 'endTimeSeconds': bucket['endTimeSeconds'] + copy_index * span}
+        return scale_list(buckets, rows, shift_bucket)
+
+    def scale_part(part):
+        if 'facets' in part:
+            part['facets'] = scale_list(part['facets'], rows, rename_facet)
+        elif 'timeSeries' in part:
+            part['timeSeries'] = scale_timeseries(part['timeSeries'])
+        elif 'results' in part and part['results'] and 'events' in part['results'][0]:
+            part['results'][0]['events'] = scale_list(part['results'][0]['events'], rows)
+
+    response = copy.deepcopy(response)
+    scale_part(response)
+    for part in ['current', 'previous']:
+        if part in response:
+            scale_part(response[part])
+    return response
+
+
+def get_recorded(name):
+    """returns the recorded response for a query name or None"""
+    try:
+        with open(os.path.join(FIXTURES_FOLDER, name + '.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def get_fixture(name, rows, recorded=False):
+    """returns a response for the shape scaled to rows, from the recorded corpus when asked and available"""
+    response = get_recorded(name) if recorded else None
+    if response is not None:
+        return scale_response(response, rows) if not name in SINGLE_ROW_SHAPES else response
+    return SHAPES[name](rows)
@@ -0,0 +1,110 @@
+#
+# load_test.py: drives the batch commands against the local mock Insights server
+#
+# author: Paulo Monteiro
+# version: 0.1
+#
+
+import argparse
+import csv
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from instrumentation import percentile
+from mock_insights_server import start_server
+
+PACKAGE_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI_FILE = os.path.join(PACKAGE_FOLDER, 'insights-cli.py')
+QUERIES_FILE = os.path.join(PACKAGE_FOLDER, 'queries-samples.yaml')
+# account columns used as parameters by queries-samples.yaml
+ACCOUNT_PARAMS = {'some_since': '1 day ago', 'some_compare': '2 days ago', 'some_limit': 1}
+
+
+def write_inputs(folder, accounts):
+    """writes the accounts list and vault files, returns their names"""
+    account_file = os.path.join(folder, 'accounts.csv')
+    with open(account_file, 'w', newline='') as f:
+        csv_writer = csv.writer(f)
+        csv_writer.writerow(['master_name', 'account_id', 'account_name', 'query_api_key'] + list(ACCOUNT_PARAMS))
+        for i in range(accounts):
+            csv_writer.writerow([f'master{i % 10}', 1000000 + i, f'account{i}', f'key{i}'] + list(ACCOUNT_PARAMS.values()))
+    vault_file = os.path.join(folder, 'vault.yaml')
+    with open(vault_file, 'w') as f:
+        f.write('load_test:\n  account_id: 1\n  query_api_key: key\n')
+    return account_file, vault_file
+
+
+def get_command(command, folder, query_file, account_file, vault_file, extra_args):
+    """returns the insights-cli command line"""
+    args = [sys.executable, CLI_FILE, command, '-q', query_file, '-a', account_file, '-v', vault_file,
+        '--checkpoint-file', os.path.join(folder, 'insights-cli.journal')]
+    if command == 'batch-local':
+        args += ['-o', os.path.join(folder, 'output')]
+    elif command == 'batch-insights':
+        args += ['-i', '1', '-k', 'insert_key']
+    return args + extra_args
+
+
+def report(stats, elapsed, queries_expected):
+    """prints throughput, latency percentiles and retry counts"""
+    counters = stats['counters']
+    print(f'elapsed {elapsed:.2f} s')
+    for endpoint in ['query', 'insert']:
+        statuses = {k.split('_', 1)[1]:v for k,v in counters.items() if k.startswith(endpoint + '_')}
+        if not statuses:
+            continue
+        requests = sum(statuses.values())
+        succeeded = statuses.get('200', 0)
+        latencies = [latency * 1000 for latency in stats['latencies'].get(endpoint, [])]
+        print(f'{endpoint:6} requests {requests:6}  ok {succeeded:6}  retries {requests - succeeded:5}  '
+            f'{succeeded / elapsed:8.1f} ok/s  statuses {dict(sorted(statuses.items()))}')
+        print(f'{"":6} latency ms p50 {percentile(latencies, 50):7.1f}  p95 {percentile(latencies, 95):7.1f}  '
+            f'p99 {percentile(latencies, 99):7.1f}  max {max(latencies, default=0):7.1f}')
+    if queries_expected:
+        print(f'{counters.get("query_200", 0)} query responses for {queries_expected} queries')
+    if counters.get('events_inserted', 0):
+        print(f'events inserted {counters["events_inserted"]}  {counters["events_inserted"] / elapsed:.0f} events/s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='load test of the batch commands against a local mock Insights server',
+        epilog='arguments after -- are passed to insights-cli, e.g. -- --concurrency 8 --rate-limit 20')
+    parser.add_argument('--command', choices=['batch-local', 'batch-insights'], default='batch-local')
+    parser.add_argument('--accounts', type=int, default=20, help='accounts in the generated accounts list')
+    parser.add_argument('--query-file', default=QUERIES_FILE, help='YAML queries file')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.5, help='latency +/- fraction')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a 500 response')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='probability of a 429 response')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds of a 429 response')
+    parser.add_argument('--rows', type=int, default=100, help='rows per query response')
+    parser.add_argument('--verbose', action='store_true', help='show the insights-cli output')
+    argv = sys.argv[1:]
+    extra_args = argv[argv.index('--') + 1:] if '--' in argv else []
+    args = parser.parse_args(argv[:argv.index('--')] if '--' in argv else argv)
+
+    server = start_server(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate, retry_after=args.retry_after, rows=args.rows)
+    env = dict(os.environ, NEW_RELIC_QUERY_API_URL=server.get_url(), NEW_RELIC_INSERT_API_URL=server.get_url())
+
+    with tempfile.TemporaryDirectory() as folder:
+        account_file, vault_file = write_inputs(folder, args.accounts)
+        with open(args.query_file) as f:
+            len_queries = sum(1 for line in f if line.startswith('- name:'))
+        command = get_command(args.command, folder, args.query_file, account_file, vault_file, extra_args)
+        print(f'{args.command}: {args.accounts} accounts x {len_queries} queries against {server.get_url()}')
+
+        start = time.perf_counter()
+        completed = subprocess.run(command, env=env, cwd=folder,
+            stdout=None if args.verbose else subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        elapsed = time.perf_counter() - start
+
+    server.shutdown()
+    report(server.get_stats(), elapsed, args.accounts * len_queries)
+    sys.exit(completed.returncode)
@@ -0,0 +1,202 @@
+#
+# mock_insights_server.py: local stand-in for the Insights Query and Insert APIs
+#
+# author: Paulo Monteiro
+# version: 0.1
+#
+
+import argparse
+from collections import Counter, defaultdict
+import gzip
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fixtures import get_fixture
+
+QUERY_PATH = re.compile(r'^/v1/accounts/(\d+)/query$')
+INSERT_PATH = re.compile(r'^/v1/accounts/(\d+)/events$')
+AGGREGATE_PATTERN = re.compile(r'\b(count|sum|average|min|max|latest|uniqueCount|percentile|percentage|histogram|apdex|funnel|rate|stddev)\s*\(', re.IGNORECASE)
+
+
+def get_shape(nrql):
+    """guesses the fixture shape answering an nrql"""
+    nrql = ' '.join(nrql.lower().split())
+    if nrql.startswith('show event types'):
+        return 'event_types'
+    if 'keyset()' in nrql:
+        return 'event_keyset'
+    compare = 'compare with' in nrql
+    facet = ' facet ' in f' {nrql} '
+    timeseries = ' timeseries' in f' {nrql} '
+    if compare:
+        return 'compared_faceted' if facet else 'compared_timeseries' if timeseries else 'compared'
+    if facet:
+        return 'faceted_timeseries' if timeseries else 'faceted'
+    if timeseries:
+        return 'timeseries'
+    if AGGREGATE_PATTERN.search(nrql):
+        return 'event_single'
+    return 'event_star' if re.search(r'\bselect\s+\*', nrql) else 'event_list'
+
+
+class MockInsightsServer(ThreadingHTTPServer):
+    """ threaded HTTP server answering queries from fixtures with injected latency and failures
+
+        - latency: mean seconds added to every request, jitter: +/- fraction of it
+        - error_rate: probability of a 500, throttle_rate: probability of a 429 with Retry-After
+        - rows: rows per response, responses are serialized once per shape
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, jitter=0.5, error_rate=0.0, throttle_rate=0.0, retry_after=1, rows=100):
+        """init"""
+        super().__init__(address, MockInsightsHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.rows = rows
+        self.__bodies = {}
+        self.__lock = threading.Lock()
+        self.__counters = Counter()
+        self.__latencies = defaultdict(list)
+
+    def get_url(self):
+        """returns the base url clients point to"""
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def get_body(self, shape):
+        """returns the serialized fixture for a shape"""
+        body = self.__bodies.get(shape, None)
+        if body is None:
+            body = self.__bodies[shape] = json.dumps(get_fixture(shape, self.rows)).encode('utf-8')
+        return body
+
+    def record(self, endpoint, status, elapsed, events=0):
+        """counts a served request"""
+        with self.__lock:
+            self.__counters[f'{endpoint}_{status}'] += 1
+            self.__counters['events_inserted'] += events
+            self.__latencies[endpoint].append(elapsed)
+
+    def get_stats(self):
+        """returns the request counters and the server side latencies per endpoint"""
+        with self.__lock:
+            return {'counters': dict(self.__counters), 'latencies': {k:list(v) for k,v in self.__latencies.items()}}
+
+    def reset_stats(self):
+        """clears the counters between runs"""
+        with self.__lock:
+            self.__counters.clear()
+            self.__latencies.clear()
+
+
+class MockInsightsHandler(BaseHTTPRequestHandler):
+    """ Query API GET, Insert API POST and /stats """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        """keeps the load test output clean"""
+        pass
+
+    def __reply(self, status, body=b'', headers={}):
+        """writes a JSON response"""
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k,v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __fail(self):
+        """sleeps the injected latency and returns an injected failure, if any"""
+        server = self.server
+        if server.latency:
+            time.sleep(max(0, server.latency * (1 + random.uniform(-server.jitter, server.jitter))))
+        draw = random.random()
+        if draw < server.throttle_rate:
+            return 429, {'Retry-After': str(server.retry_after)}
+        if draw < server.throttle_rate + server.error_rate:
+            return 500, {}
+        return None, {}
+
+    def do_GET(self):
+        """query endpoint and stats"""
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            return self.__reply(200, json.dumps(self.server.get_stats()).encode('utf-8'))
+        if not QUERY_PATH.match(url.path):
+            return self.__reply(404, b'{"error": "not found"}')
+        status, headers = self.__fail()
+        if status:
+            self.__reply(status, b'{"error": "injected"}', headers)
+        else:
+            nrql = parse_qs(url.query).get('nrql', [''])[0]
+            status = 200
+            self.__reply(status, self.server.get_body(get_shape(nrql)))
+        self.server.record('query', status, time.perf_counter() - start)
+
+    def do_POST(self):
+        """insert endpoint, plain or gzip JSON list of events"""
+        start = time.perf_counter()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not INSERT_PATH.match(urlparse(self.path).path):
+            return self.__reply(404, b'{"error": "not found"}')
+        status, headers = self.__fail()
+        events = 0
+        if status:
+            self.__reply(status, b'{"error": "injected"}', headers)
+        else:
+            try:
+                if self.headers.get('Content-Encoding', '') == 'gzip':
+                    body = gzip.decompress(body)
+                events = len(json.loads(body))
+                status = 200
+                self.__reply(status, b'{"success": true}')
+            except (OSError, ValueError, TypeError):
+                status = 400
+                self.__reply(status, b'{"error": "invalid payload"}')
+        self.server.record('insert', status, time.perf_counter() - start, events)
+
+
+def start_server(**kwargs):
+    """starts a server on a background thread and returns it"""
+    server = MockInsightsServer(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='local mock of the Insights Query and Insert APIs')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.05, help='mean seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.5, help='latency +/- fraction')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a 500 response')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='probability of a 429 response')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds of a 429 response')
+    parser.add_argument('--rows', type=int, default=100, help='rows per query response')
+    args = parser.parse_args()
+
+    server = MockInsightsServer((args.host, args.port), args.latency, args.jitter,
+        args.error_rate, args.throttle_rate, args.retry_after, args.rows)
+    print(f'serving on {server.get_url()}, set NEW_RELIC_QUERY_API_URL and NEW_RELIC_INSERT_API_URL to it')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,37 @@
+#
+# record_fixtures.py: records live Query API responses for the offline benchmarks
+#
+# author: Paulo Monteiro
+# version: 0.1
+#
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yaml
+
+from newrelic_query_api import NewRelicQueryAPI
+from fixtures import FIXTURES_FOLDER
+
+QUERIES_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'queries-samples.yaml')
+PARAMS = {'some_since': '1 day ago', 'some_compare': '2 days ago', 'some_limit': 1}
+
+
+# uses NEW_RELIC_ACCOUNT_ID and NEW_RELIC_QUERY_API_KEY, optional args filter query names
+if __name__ == '__main__':
+    with open(QUERIES_FILE) as f:
+        queries = yaml.load(f, Loader=yaml.FullLoader)
+    os.makedirs(FIXTURES_FOLDER, exist_ok=True)
+    api = NewRelicQueryAPI()
+    for query in queries:
+        if len(sys.argv) == 1 or query['name'] in sys.argv:
+            response = api.query(query['nrql'], params=PARAMS)
+            if not response:
+                print(f'{query["name"]}: no response, skipped')
+                continue
+            with open(os.path.join(FIXTURES_FOLDER, query['name'] + '.json'), 'w') as f:
+                json.dump(response, f, indent=2)
+            print(f'{query["name"]}: recorded')
@@ -0,0 +1,94 @@
+#
+# author: Paulo Monteiro
+# version: 0.1
+#
+
+import json
+import os
+
+
+def get_journal_run_folder(journal_file):
+    """returns the run folder recorded in a journal without opening it for writing"""
+    try:
+        with open(journal_file) as f:
+            return json.loads(f.readline()).get('run_folder', None)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class Checkpoint():
+    """ append only journal of a batch run
+
+        - the first record stores the run folder (local path or Google Drive folder name)
+        - every other record is a completed (master_name, account_id, query name) tuple
+        - a journal file set to None keeps everything in memory
+    """
+
+    def __init__(self, journal_file=None, resume=False):
+        """init"""
+        self.__journal_file = journal_file
+        self.__completed = set()
+        self.__run_folder = None
+        self.__handle = None
+        if journal_file and resume:
+            try:
+                with open(journal_file) as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue # a crash can leave the last line truncated
+                        if 'run_folder' in record:
+                            self.__run_folder = record['run_folder']
+                        else:
+                            self.__completed.add(self.__get_key(**record))
+            except FileNotFoundError:
+                pass
+        if journal_file:
+            self.__handle = open(journal_file, 'a' if resume else 'w')
+
+    def __get_key(self, master_name='', account_id='', query_name=''):
+        """normalize the tuple, account ids can be either int or str"""
+        return (str(master_name), str(account_id), str(query_name))
+
+    def __write(self, record):
+        """append a record to the journal and flush it to disk"""
+        if self.__handle:
+            self.__handle.write(json.dumps(record) + '\n')
+            self.__handle.flush()
+            os.fsync(self.__handle.fileno())
+
+    def get_run_folder(self):
+        """returns the run folder of a resumed run or None"""
+        return self.__run_folder
+
+    def get_completed(self):
+        """returns how many queries were already completed"""
+        return len(self.__completed)
+
+    def start(self, run_folder):
+        """records the run folder unless resuming a run that already has one"""
+        if self.__run_folder is None and run_folder is not None:
+            self.__run_folder = run_folder
+            self.__write({'run_folder': run_folder})
+
+    def is_completed(self, master_name, account_id, query_name):
+        """checks if the query was already dumped to storage"""
+        return self.__get_key(master_name, account_id, query_name) in self.__completed
+
+    def complete(self, master_name, account_id, query_name):
+        """marks the query as dumped to storage"""
+        self.__completed.add(self.__get_key(master_name, account_id, query_name))
+        self.__write({'master_name': master_name, 'account_id': account_id, 'query_name': query_name})
+
+    def destroy(self, remove=True):
+        """closes and removes the journal once the run finished successfully, remove=False keeps it"""
+        if self.__handle:
+            self.__handle.close()
+            self.__handle = None
+            if not remove:
+                return
+            try:
+                os.remove(self.__journal_file)
+            except OSError:
+                pass
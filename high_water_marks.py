@@ -0,0 +1,66 @@
+#
+# author: Paulo Monteiro
+# version: 0.1
+#
+
+import json
+import os
+import threading
+
+
+class HighWaterMarks():
+    """ end time of the last window fetched per (master_name, account_id, query name)
+
+        - kept between runs in a JSON lines state file, the last record of a key wins
+        - the file is compacted when opened, so it only grows with the current run; shards
+          share the file and only append to it, see compact
+        - marks never move backwards, update and destroy are thread safe
+    """
+
+    def __init__(self, state_file, compact=True):
+        """init, compact=False leaves the file as is for the processes appending to it concurrently"""
+        self.__marks = {}
+        try:
+            with open(state_file) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        self.__marks[self.__get_key(record['master_name'], record['account_id'], record['query_name'])] = record['end_time']
+                    except (ValueError, KeyError):
+                        continue # a crash can leave the last line truncated
+        except FileNotFoundError:
+            pass
+        if compact:
+            with open(state_file + '.tmp', 'w') as f:
+                for (master_name, account_id, query_name),end_time in self.__marks.items():
+                    f.write(json.dumps({'master_name': master_name, 'account_id': account_id, 'query_name': query_name, 'end_time': end_time}) + '\n')
+            os.replace(state_file + '.tmp', state_file)
+        self.__handle = open(state_file, 'a')
+        self.__lock = threading.Lock()
+
+    def __get_key(self, master_name='', account_id='', query_name=''):
+        """normalize the tuple, account ids can be either int or str"""
+        return (str(master_name), str(account_id), str(query_name))
+
+    def get(self, master_name, account_id, query_name):
+        """returns the end time in epoch seconds of the last window fetched or None"""
+        return self.__marks.get(self.__get_key(master_name, account_id, query_name), None)
+
+    def update(self, master_name, account_id, query_name, end_time):
+        """records the end time of a window once its rows are written"""
+        key = self.__get_key(master_name, account_id, query_name)
+        with self.__lock:
+            if end_time is None or end_time <= self.__marks.get(key, 0):
+                return
+            self.__marks[key] = end_time
+            if self.__handle:
+                self.__handle.write(json.dumps({'master_name': key[0], 'account_id': key[1], 'query_name': key[2], 'end_time': end_time}) + '\n')
+                self.__handle.flush()
+                os.fsync(self.__handle.fileno())
+
+    def destroy(self):
+        """closes the state file, once the storage has written everything and run its callbacks"""
+        with self.__lock:
+            if self.__handle:
+                self.__handle.close()
+                self.__handle = None
@@ -5,18 +5,29 @@
 # version: 0.1
 #
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from functools import partial
 import csv
 import json
 import os
+import subprocess
 import sys
-import yaml
+import time
+import zlib
 
+from checkpoint import Checkpoint, get_journal_run_folder
+from high_water_marks import HighWaterMarks
+from instrumentation import METRICS
 from insights_cli_argparse import parse_cmdline
-from newrelic_query_api import NewRelicQueryAPI
-from storage_local import StorageLocal
-from storage_google_drive import StorageGoogleDrive
-from storage_newrelic_insights import StorageNewRelicInsights
+from newrelic_query_api import NewRelicQueryAPI, get_end_time, merge_nrqls, new_session, parse_nrql, parse_rows, CLOSED_WINDOW_LAG, POOL_SIZE
+from query_cache import QueryCache, CACHE_SIZE_MB, CACHE_TTL
+from rate_limiter import AdaptiveConcurrency
+from storage_local import StorageLocal, merge_shards
+
+# yaml and the other storages are imported by the commands using them, so query and the
+# local commands do not load the Google API client or pyarrow
 
 
 def msg(message, *args, stop=True):
@@ -45,6 +56,7 @@ def open_file(filename=None, mode='r', *args, **kwargs):
 
 def open_yaml(yaml_file):
     """open and parse an yaml file"""
+    import yaml
     try:
         with open_file(yaml_file) as f:
             data = yaml.load(f, Loader=yaml.FullLoader)
@@ -83,7 +95,72 @@ def validate_accounts(accounts, keys):
     return len(accounts)
 
 
-def export_events(storage, vault_file, query_file, master_names):
+def bounded_map(executor, fn, items, window):
+    """like executor.map but keeps at most window tasks in flight, yielding results in order"""
+    pending = deque()
+    for item in items:
+        pending.append((item, executor.submit(fn, item)))
+        if len(pending) >= window:
+            item, future = pending.popleft()
+            yield item, future.result()
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+def get_window(query, since, until):
+    """returns the incremental query with its {since} / {until} parameters set
+
+        since / until are epoch seconds, a query without a high-water mark yet
+        starts at its since key (e.g. 1 day ago)
+    """
+    window = {'since': since * 1000 if since else query.get('since', None), 'until': until * 1000}
+    window = {k:v for k,v in window.items() if v is not None}
+    return {**query, 'nrql': parse_nrql(query['nrql'], window)}
+
+
+def get_shard_suffix(shard):
+    """file name suffix of the outputs and journal files of a shard"""
+    return f'.shard{shard[0]}' if shard else ''
+
+
+def in_shard(account, shard, shard_key='master_name'):
+    """checks if an account belongs to the (index, count) shard, hashing its shard_key column"""
+    if not shard:
+        return True
+    index, count = shard
+    return zlib.crc32(str(account.get(shard_key, '')).encode('utf-8')) % count == index
+
+
+def get_shard_args(kargs):
+    """a shard keeps its own journal, the marks in the state file are already per account"""
+    if kargs.get('checkpoint_file', None):
+        kargs['checkpoint_file'] += get_shard_suffix(kargs.get('shard', None))
+    return kargs
+
+
+def merge_tasks(tasks):
+    """groups the tasks of the same account and API key whose queries merge into one request"""
+    accounts = {}
+    for task in tasks:
+        _, account, _, query, account_id, query_api_key, _ = task
+        if query.get('windows', 1) > 1:
+            accounts[(id(task),)] = [task] # split queries run on their own
+        else:
+            accounts.setdefault((id(account), account_id, query_api_key), []).append(task)
+
+    # tasks are indexed by parsed nrql position and batches sorted by their first task
+    batches = []
+    for account_tasks in accounts.values():
+        metadata = account_tasks[0][6]
+        nrqls = [parse_nrql(query['nrql'], metadata) for _, _, _, query, _, _, _ in account_tasks]
+        for _,members in merge_nrqls(nrqls):
+            batches.append([account_tasks[index] for index,_,_ in members])
+    order = {id(task):i for i,task in enumerate(tasks)}
+    return sorted(batches, key=lambda batch: order[id(batch[0])])
+
+
+def export_events(storage, vault_file, query_file, master_names, concurrency=1, cache_dir='', cache_ttl=CACHE_TTL, cache_size=CACHE_SIZE_MB, checkpoint=None, rate_limit=0, metrics_file='', merge_queries=False, marks=None, shard=None, shard_key='master_name', **kargs):
     """executes all queries against all accounts and dump to storage"""
     vault = open_yaml(vault_file)
     validate_vault(vault)
@@ -94,20 +171,35 @@ def export_events(storage, vault_file, query_file, master_names):
     accounts = storage.get_accounts()
     len_accounts = validate_accounts(accounts, ['master_name', 'account_name', 'account_id', 'query_api_key'])
 
+    # a resumed run keeps writing to the same run folder
+    if not checkpoint:
+        checkpoint = Checkpoint()
+    elif checkpoint.get_completed():
+        msg('resuming run {} with {} queries already completed',
+            checkpoint.get_run_folder(), checkpoint.get_completed(), stop=False)
+    checkpoint.start(storage.get_run_folder())
+
+    # incremental queries fetch from their last window end up to this run start,
+    # less the lag late events need to arrive, so the next run does not skip them
+    until = int(time.time()) - CLOSED_WINDOW_LAG
+
+    # build the (account, query) matrix in the same order the serial loop walked it
+    tasks = []
     for idx_account,account in enumerate(accounts):
         master_name = account['master_name']
-        account_name = account['account_name']
         try:
             if not master_name in master_names:
                 continue
         except:
             pass
+        if not in_shard(account, shard, shard_key):
+            continue
 
         metadata = {k:v for k,v in account.items() if not 'key' in k}
 
         for idx_query,query in enumerate(queries):
-            name = query['name']
-            nrql = query['nrql']
+            if checkpoint.is_completed(master_name, account['account_id'], query['name']):
+                continue
             try:
                 secret = query['secret']
                 account_id = vault[secret]['account_id']
@@ -115,36 +207,190 @@ def export_events(storage, vault_file, query_file, master_names):
             except:
                  account_id = account['account_id']
                  query_api_key = account['query_api_key']
+            if marks and '{since}' in query['nrql']:
+                query = get_window(query, marks.get(master_name, account['account_id'], query['name']), until)
+            tasks.append((idx_account, account, idx_query, query, account_id, query_api_key, metadata))
 
-            msg('account {}/{}: {} - {}, query {}/{}: {}',
-                idx_account+1, len_accounts, account_id, account_name, idx_query+1, len_queries, name,
-                stop=False
-            )
+    # a batch of tasks is fetched in one round trip, merging compatible single value selects
+    if merge_queries:
+        batches = merge_tasks(tasks)
+    else:
+        batches = [[task] for task in tasks]
 
-            api = NewRelicQueryAPI(account_id, query_api_key)
-            events = list(api.events(nrql, include=metadata, params=metadata))
-            storage.dump_data(master_name, name, events)
+    # one keep-alive connection pool shared by all accounts and worker threads
+    concurrency = max(1, concurrency or 1)
+    session = new_session(pool_size=max(concurrency, POOL_SIZE))
 
+    # requests in flight adapt to throttling, concurrency is only the ceiling
+    controller = AdaptiveConcurrency(concurrency)
 
-def do_batch_local(query_file='', vault_file='', master_names=[], account_file='', output_folder='', **kargs):
+    # responses already fetched by a previous run are read back from disk
+    if cache_dir:
+        cache = QueryCache(cache_dir, cache_ttl, cache_size * 1024 * 1024)
+    else:
+        cache = None
+
+    # timing records of every request, parse and storage write
+    if metrics_file:
+        METRICS.start(metrics_file)
+
+    def get_metrics_context(batch):
+        """fields identifying the batch in the metrics records"""
+        _, account, _, _, _, _, _ = batch[0]
+        query_name = '+'.join(query['name'] for _, _, _, query, _, _, _ in batch)
+        return METRICS.context(master_name=account['master_name'], account_id=account['account_id'], query_name=query_name)
+
+    def fetch_responses(batch):
+        """runs on a worker thread: only the network round trip happens here"""
+        _, _, _, query, account_id, query_api_key, metadata = batch[0]
+        api = NewRelicQueryAPI(account_id, query_api_key, session=session, cache=cache,
+            rate_limit=rate_limit, concurrency=controller)
+        with get_metrics_context(batch):
+            if len(batch) > 1:
+                return api.query_many([query['nrql'] for _, _, _, query, _, _, _ in batch], params=metadata)
+            return [api.query(query['nrql'], params=metadata, windows=query.get('windows', 1))]
+
+    # a failed run still flushes its timings and prints the summary
+    try:
+        # fan out the queries but keep storage writes serialized and in matrix order
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for batch,responses in bounded_map(executor, fetch_responses, batches, concurrency * 2):
+                for task,response in zip(batch, responses):
+                    idx_account, account, idx_query, query, account_id, _, metadata = task
+                    msg('account {}/{}: {} - {}, query {}/{}: {}',
+                        idx_account+1, len_accounts, account_id, account['account_name'], idx_query+1, len_queries, query['name'],
+                        stop=False
+                    )
+                    # rows are parsed lazily while the storage consumes them
+                    with get_metrics_context([task]), METRICS.timer('write'):
+                        rows = parse_rows(response, include=metadata)
+                        storage.dump_data(account['master_name'], query['name'], rows)
+                    # buffered storages journal the query once its rows are actually written
+                    storage.when_written(partial(checkpoint.complete, account['master_name'], account['account_id'], query['name']))
+                    if marks and '{since}' in queries[idx_query]['nrql']:
+                        storage.when_written(partial(marks.update, account['master_name'], account['account_id'], query['name'], get_end_time(response)))
+    finally:
+        if metrics_file:
+            for line in METRICS.get_report():
+                msg(line, stop=False)
+            METRICS.stop()
+
+
+def run_workers(command='', workers=1, checkpoint_file='', resume=False, output_folder='', incremental=False, state_file='', **kargs):
+    """runs a batch command in workers subprocesses, one shard each"""
+    # the workers share the state file and only append to it, it is compacted once here
+    if incremental and state_file:
+        HighWaterMarks(state_file).destroy()
+    # the shards of a local run share its run folder, batch-local shards are merged at the end
+    run_folder = None
+    if command in ['do_batch_local', 'do_batch_parquet']:
+        if resume:
+            # any shard journal records it, the shards that finished keep theirs until all do
+            run_folders = [get_journal_run_folder(checkpoint_file + get_shard_suffix((index, workers))) for index in range(workers)]
+            run_folder = next((folder for folder in run_folders if folder), None)
+        if not run_folder:
+            run_folder = StorageLocal('', output_folder).get_run_folder()
+    argv = sys.argv[1:] + ['--workers', '1', '--keep-journal'] + (['--run-folder', run_folder] if run_folder else [])
+    processes = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__)] + argv + ['--shard', f'{index}/{workers}'])
+        for index in range(workers)
+    ]
+    failed = [process for process in processes if process.wait() != 0]
+    if failed:
+        msg('error: {} of {} workers failed, run the same command with -r to resume them', len(failed), workers)
+    if command == 'do_batch_local':
+        merged = merge_shards(run_folder)
+        msg('merged {} sharded files in {}', len(merged), run_folder, stop=False)
+    for index in range(workers):
+        Checkpoint(checkpoint_file + get_shard_suffix((index, workers))).destroy()
+
+
+def do_merge_local(run_folder='', **kargs):
+    """merge-local command"""
+    if not os.path.isdir(run_folder):
+        msg(f'error: cannot open folder {run_folder}')
+    merged = merge_shards(run_folder)
+    msg('merged {} sharded files in {}', len(merged), run_folder, stop=False)
+
+
+def do_batch_local(query_file='', vault_file='', master_names=[], account_file='', output_folder='', checkpoint_file='', resume=False, incremental=False, state_file='', run_folder=None, shard=None, keep_journal=False, **kargs):
     """batch-local command"""
-    storage = StorageLocal(account_file, output_folder)
-    export_events(storage, vault_file, query_file, master_names)
+    checkpoint = Checkpoint(checkpoint_file, resume)
+    marks = HighWaterMarks(state_file, compact=not shard) if incremental and state_file else None
+    storage = StorageLocal(account_file, output_folder, run_folder=checkpoint.get_run_folder() or run_folder, suffix=get_shard_suffix(shard),
+        is_completed=checkpoint.is_completed if resume else None)
+    export_events(storage, vault_file, query_file, master_names, checkpoint=checkpoint, marks=marks, shard=shard, **kargs)
+    storage.destroy()
+    if marks:
+        marks.destroy()
+    checkpoint.destroy(remove=not keep_journal)
+
+
+def do_batch_parquet(query_file='', vault_file='', master_names=[], account_file='', output_folder='', checkpoint_file='', resume=False, incremental=False, state_file='', run_folder=None, shard=None, keep_journal=False, **kargs):
+    """batch-parquet command"""
+    from storage_parquet import StorageParquet
+    checkpoint = Checkpoint(checkpoint_file, resume)
+    marks = HighWaterMarks(state_file, compact=not shard) if incremental and state_file else None
+    storage = StorageParquet(account_file, output_folder, run_folder=checkpoint.get_run_folder() or run_folder, suffix=get_shard_suffix(shard))
+    export_events(storage, vault_file, query_file, master_names, checkpoint=checkpoint, marks=marks, shard=shard, **kargs)
+    storage.destroy()
+    if marks:
+        marks.destroy()
+    checkpoint.destroy(remove=not keep_journal)
+
+
+def do_batch_sqlite(query_file='', vault_file='', master_names=[], account_file='', database_file='', checkpoint_file='', resume=False, incremental=False, state_file='', shard=None, keep_journal=False, **kargs):
+    """batch-sqlite command"""
+    from storage_sqlite import StorageSQLite
+    checkpoint = Checkpoint(checkpoint_file, resume)
+    marks = HighWaterMarks(state_file, compact=not shard) if incremental and state_file else None
+    storage = StorageSQLite(account_file, database_file)
+    export_events(storage, vault_file, query_file, master_names, checkpoint=checkpoint, marks=marks, shard=shard, **kargs)
     storage.destroy()
+    if marks:
+        marks.destroy()
+    checkpoint.destroy(remove=not keep_journal)
 
 
-def do_batch_google(query_file='', vault_file='', master_names=[], account_file_id='', output_folder_id='', secret_file='', pivot_file='', **kargs):
+def do_batch_google(query_file='', vault_file='', master_names=[], account_file_id='', output_folder_id='', secret_file='', pivot_file='', checkpoint_file='', resume=False, incremental=False, state_file='', compact_cells=False, shard=None, keep_journal=False, **kargs):
     """batch-local command"""
-    storage = StorageGoogleDrive(account_file_id, output_folder_id, secret_file)
-    export_events(storage, vault_file, query_file, master_names)
+    from storage_google_drive import StorageGoogleDrive
+    checkpoint = Checkpoint(checkpoint_file, resume)
+    marks = HighWaterMarks(state_file, compact=not shard) if incremental and state_file else None
+    # every shard writes to its own Drive run folder
+    storage = StorageGoogleDrive(account_file_id, output_folder_id, secret_file, prefix='RUN' + get_shard_suffix(shard),
+        run_folder=checkpoint.get_run_folder(), compact=compact_cells)
+    export_events(storage, vault_file, query_file, master_names, checkpoint=checkpoint, marks=marks, shard=shard, **kargs)
     pivots = open_yaml(pivot_file) if pivot_file else {}
     storage.format_data(pivots)
+    if marks:
+        marks.destroy()
+    checkpoint.destroy(remove=not keep_journal)
 
 
-def do_batch_insights(query_file='', vault_file='', master_names=[], account_file='', insert_account_id='', insert_api_key='', **kargs):
+def do_batch_insights(query_file='', vault_file='', master_names=[], account_file='', insert_account_id='', insert_api_key='', checkpoint_file='', resume=False, incremental=False, state_file='', spool_dir='', shard=None, keep_journal=False, **kargs):
     """batch-insights command"""
-    storage = StorageNewRelicInsights(account_file, insert_account_id, insert_api_key)
-    export_events(storage, vault_file, query_file, master_names)
+    from storage_newrelic_insights import StorageNewRelicInsights
+    checkpoint = Checkpoint(checkpoint_file, resume)
+    marks = HighWaterMarks(state_file, compact=not shard) if incremental and state_file else None
+    storage = StorageNewRelicInsights(account_file, insert_account_id, insert_api_key, spool_dir=spool_dir)
+    export_events(storage, vault_file, query_file, master_names, checkpoint=checkpoint, marks=marks, shard=shard, **kargs)
+    storage.destroy()
+    if marks:
+        marks.destroy()
+    checkpoint.destroy(remove=not keep_journal)
+
+
+def do_replay_insights(insert_account_id='', insert_api_key='', spool_dir='', concurrency=0, **kargs):
+    """replay-insights command"""
+    from storage_newrelic_insights import StorageNewRelicInsights
+    storage = StorageNewRelicInsights('', insert_account_id, insert_api_key,
+        workers=concurrency or StorageNewRelicInsights.INSERT_WORKERS, spool_dir=spool_dir)
+    replayed, spooled = storage.replay()
+    storage.destroy()
+    msg('replayed {} of {} spooled payloads from {}', replayed, spooled, spool_dir, stop=False)
+    if replayed < spooled:
+        msg('error: {} payloads remain in {}, run replay-insights again', spooled - replayed, spool_dir)
 
 
 def do_query(query='', output_file='', output_format='', account_id='', query_api_key='', **kargs):
@@ -169,24 +415,35 @@ def do_query(query='', output_file='', output_format='', account_id='', query_ap
         nrql = query
 
     api = NewRelicQueryAPI(account_id, query_api_key)
-    events = list(api.events(nrql, include={'account_id': account_id}))
-
-    if not len(events):
-        msg('warning: empty events list returned', stop=False)
+    if output_format == 'json':
+        events = list(api.events(nrql, include={'account_id': account_id}))
+    else:
+        rows = api.rows(nrql, include={'account_id': account_id})
+    count_events = 0
 
     try:
         with open_file(output_file, 'w') as f:
             if output_format == 'json':
                 json.dump(events, f, sort_keys=True, indent=4)
-            elif events:
-                csv_writer = csv.DictWriter(f, fieldnames=events[0].keys())
-                csv_writer.writeheader()
-                for event in events:
-                    csv_writer.writerow(event)
+                count_events = len(events)
+            elif rows.header:
+                csv_writer = csv.writer(f)
+                csv_writer.writerow(rows.header)
+                for row in rows:
+                    csv_writer.writerow(row)
+                    count_events += 1
     except:
         msg(f'error: cannot write to {output_file}')
 
+    if not count_events:
+        msg('warning: empty events list returned', stop=False)
+
 
 if __name__ == '__main__':
     args, error = parse_cmdline()
-    locals()[args.command](**vars(args)) if not error else error()
\ No newline at end of file
+    if error:
+        error()
+    elif getattr(args, 'workers', 1) > 1:
+        run_workers(**vars(args))
+    else:
+        locals()[args.command](**get_shard_args(vars(args)))
\ No newline at end of file
@@ -1,5 +1,19 @@
 import argparse
 
+from query_cache import CACHE_SIZE_MB, CACHE_TTL
+
+
+def parse_shard(shard):
+    """parses an index/count shard, e.g. 0/4"""
+    try:
+        index, count = [int(k) for k in shard.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{shard} is not an index/count shard, e.g. 0/4')
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'shard index must be between 0 and {count - 1}')
+    return index, count
+
+
 def parse_cmdline():
     """parse the command line"""
     parser = argparse.ArgumentParser()
@@ -7,13 +21,90 @@ def parse_cmdline():
     subparsers = parser.add_subparsers()
     prepare_query_parser(subparsers)
     prepare_batch_local_parser(subparsers)
+    prepare_batch_parquet_parser(subparsers)
+    prepare_batch_sqlite_parser(subparsers)
     prepare_batch_google_parser(subparsers)
     prepare_batch_insights_parser(subparsers)
+    prepare_replay_insights_parser(subparsers)
+    prepare_merge_local_parser(subparsers)
     args = parser.parse_args()
     error = parser.print_help if args.command == None else None
     return args, error
 
 
+def prepare_batch_options(batch_parser):
+    """options shared by all batch commands"""
+    batch_parser.add_argument('-c', '--concurrency',
+        help='Maximum number of queries executed in parallel, backs off when throttled',
+        type=int,
+        default=1
+    )
+    batch_parser.add_argument('--rate-limit',
+        help='Maximum query requests per second per API key, 0 means unlimited',
+        type=float,
+        default=0
+    )
+    batch_parser.add_argument('--cache-dir',
+        help='Local folder caching query results between runs'
+    )
+    batch_parser.add_argument('--cache-ttl',
+        help='Seconds a cached query result remains valid',
+        type=int,
+        default=CACHE_TTL
+    )
+    batch_parser.add_argument('--cache-size',
+        help='Maximum cache folder size in MB, least recently used results are evicted first, 0 means unlimited',
+        type=int,
+        default=CACHE_SIZE_MB
+    )
+    batch_parser.add_argument('--merge-queries',
+        help='Merge single value queries of an account sharing the same FROM ... clause into one request',
+        action='store_true'
+    )
+    batch_parser.add_argument('--metrics-file',
+        help='Local JSON lines file of request, parse and storage write timings, a summary is printed at the end of the run'
+    )
+    batch_parser.add_argument('--incremental',
+        help='Queries with {since} in the nrql fetch from the end of their last fetched window up to 5 minutes ago',
+        action='store_true'
+    )
+    batch_parser.add_argument('--state-file',
+        help='Local file keeping the end of the last fetched window per master, account and query',
+        default='insights-cli.state'
+    )
+    batch_parser.add_argument('--shard',
+        help='Only run the accounts of shard index/count, e.g. 0/4, outputs and journal files get a .shardN suffix',
+        type=parse_shard
+    )
+    batch_parser.add_argument('--shard-key',
+        help='Account column hashed to pick the shard, master_name keeps the files of a master in one shard',
+        choices=['master_name', 'account_id'],
+        default='master_name'
+    )
+    batch_parser.add_argument('--workers',
+        help='Run the command as this many worker processes, one shard each, batch-local shards are merged at the end',
+        type=int,
+        default=1
+    )
+    # set by --workers so all shards share the same run folder
+    batch_parser.add_argument('--run-folder',
+        help=argparse.SUPPRESS
+    )
+    # set by --workers so the journals of finished shards are kept until all the workers finish
+    batch_parser.add_argument('--keep-journal',
+        help=argparse.SUPPRESS,
+        action='store_true'
+    )
+    batch_parser.add_argument('-r', '--resume',
+        help='Resume the last run recorded in the checkpoint file, skipping completed queries',
+        action='store_true'
+    )
+    batch_parser.add_argument('--checkpoint-file',
+        help='Local journal of completed queries, removed when the run finishes',
+        default='insights-cli.journal'
+    )
+
+
 def prepare_query_parser(subparsers):
     query_parser = subparsers.add_parser('query')
     query_parser.set_defaults(command='do_query')
@@ -58,6 +149,55 @@ def prepare_batch_local_parser(subparsers):
     batch_local_parser.add_argument('-m', '--master-names',
         help='Filter master names from account list', nargs='+'
     )
+    prepare_batch_options(batch_local_parser)
+
+
+def prepare_batch_parquet_parser(subparsers):
+    batch_parquet_parser = subparsers.add_parser('batch-parquet')
+    batch_parquet_parser.set_defaults(command='do_batch_parquet')
+    batch_parquet_parser.add_argument('-v', '--vault-file',
+        help='Local YAML vault file [secret:{account_id,query_api_key}]',
+    )
+    batch_parquet_parser.add_argument('-q', '--query-file',
+        help='Local YAML queries file [{name,nrql}]',
+        required=True
+    )
+    batch_parquet_parser.add_argument('-a', '--account-file',
+        help='Local accounts list CSV file [master_name,account_id,account_name,query_api_key]',
+        required=True
+    )
+    batch_parquet_parser.add_argument('-o', '--output-folder',
+        help='Local output folder name',
+        required=True
+    )
+    batch_parquet_parser.add_argument('-m', '--master-names',
+        help='Filter master names from account list', nargs='+'
+    )
+    prepare_batch_options(batch_parquet_parser)
+
+
+def prepare_batch_sqlite_parser(subparsers):
+    batch_sqlite_parser = subparsers.add_parser('batch-sqlite')
+    batch_sqlite_parser.set_defaults(command='do_batch_sqlite')
+    batch_sqlite_parser.add_argument('-v', '--vault-file',
+        help='Local YAML vault file [secret:{account_id,query_api_key}]',
+    )
+    batch_sqlite_parser.add_argument('-q', '--query-file',
+        help='Local YAML queries file [{name,nrql}]',
+        required=True
+    )
+    batch_sqlite_parser.add_argument('-a', '--account-file',
+        help='Local accounts list CSV file [master_name,account_id,account_name,query_api_key]',
+        required=True
+    )
+    batch_sqlite_parser.add_argument('-d', '--database-file',
+        help='Local SQLite database file shared by all runs, one table per query',
+        default='insights.db'
+    )
+    batch_sqlite_parser.add_argument('-m', '--master-names',
+        help='Filter master names from account list', nargs='+'
+    )
+    prepare_batch_options(batch_sqlite_parser)
 
 
 def prepare_batch_google_parser(subparsers):
@@ -89,6 +229,11 @@ def prepare_batch_google_parser(subparsers):
     batch_google_parser.add_argument('-m', '--master-names',
         help='Filter master names from account list', nargs='+'
     )
+    batch_google_parser.add_argument('--compact-cells',
+        help='Upload values only and set number and date formats once per column, smaller requests for large sheets',
+        action='store_true'
+    )
+    prepare_batch_options(batch_google_parser)
 
 
 def prepare_batch_insights_parser(subparsers):
@@ -116,4 +261,41 @@ def prepare_batch_insights_parser(subparsers):
     )
     batch_insights_parser.add_argument('-m', '--master-names',
         help='Filter master names from account list', nargs='+'
+    )
+    batch_insights_parser.add_argument('--spool-dir',
+        help='Local folder keeping the events that could not be inserted, see replay-insights',
+        default='insights-spool'
+    )
+    prepare_batch_options(batch_insights_parser)
+
+
+def prepare_replay_insights_parser(subparsers):
+    replay_insights_parser = subparsers.add_parser('replay-insights')
+    replay_insights_parser.set_defaults(command='do_replay_insights')
+    replay_insights_parser.add_argument('-i', '--insert-account-id',
+        help='New Relic Insights insert account id',
+        type=int,
+        required=True
+    )
+    replay_insights_parser.add_argument('-k', '--insert-api-key',
+        help='New Relic Insights insert API key',
+        required=True
+    )
+    replay_insights_parser.add_argument('--spool-dir',
+        help='Local folder with the events batch-insights could not insert',
+        default='insights-spool'
+    )
+    replay_insights_parser.add_argument('-c', '--concurrency',
+        help='Maximum number of payloads sent in parallel, 0 means the default number of insert workers',
+        type=int,
+        default=0
+    )
+
+
+def prepare_merge_local_parser(subparsers):
+    merge_local_parser = subparsers.add_parser('merge-local')
+    merge_local_parser.set_defaults(command='do_merge_local')
+    merge_local_parser.add_argument('-f', '--run-folder',
+        help='Local run folder with the .shardN.csv files written by batch-local shards',
+        required=True
     )
\ No newline at end of file
@@ -0,0 +1,171 @@
+#
+# author: Paulo Monteiro
+# version: 0.1
+#
+
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+REPORT_TOP = 5
+
+
+def percentile(values, p):
+    """nearest rank percentile of a list"""
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+class Metrics():
+    """ thread safe collector of timing records
+
+        - every record is a dict with kind, time, elapsed seconds and the caller fields
+        - fields set by context() on a thread (account, query, ...) are added to its records
+        - a timer excludes the time of the lazy iterables consumed inside it, so writing
+          rows parsed on the fly is not counted twice
+        - records are appended to a JSON lines file, if any, and aggregated by get_report()
+        - while disabled records and timers cost nothing
+    """
+
+    def __init__(self):
+        """init"""
+        self.enabled = False
+        self.__records = []
+        self.__handle = None
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__started = None
+
+    def start(self, metrics_file=''):
+        """enables collection, writing JSON lines to metrics_file if set"""
+        with self.__lock:
+            self.__records = []
+            self.__handle = open(metrics_file, 'w') if metrics_file else None
+            self.__started = time.perf_counter()
+            self.enabled = True
+
+    def stop(self):
+        """disables collection and closes the JSON lines file"""
+        with self.__lock:
+            self.enabled = False
+            if self.__handle:
+                self.__handle.close()
+                self.__handle = None
+
+    @contextmanager
+    def context(self, **fields):
+        """adds fields to the records made by the current thread"""
+        previous = getattr(self.__local, 'fields', {})
+        self.__local.fields = {**previous, **fields}
+        try:
+            yield
+        finally:
+            self.__local.fields = previous
+
+    def bind(self, function):
+        """wraps function to run with the current thread fields, for work handed to other threads"""
+        fields = getattr(self.__local, 'fields', {})
+        def bound(*args, **kwargs):
+            with self.context(**fields):
+                return function(*args, **kwargs)
+        return bound
+
+    def record(self, kind, elapsed=0.0, **fields):
+        """stores a record"""
+        if not self.enabled:
+            return
+        record = {'kind': kind, 'time': time.time(), 'elapsed': elapsed, **getattr(self.__local, 'fields', {}), **fields}
+        with self.__lock:
+            self.__records.append(record)
+            if self.__handle:
+                self.__handle.write(json.dumps(record, default=str) + '\n')
+
+    @contextmanager
+    def timer(self, kind, **fields):
+        """records the time of the with block, the yielded dict adds fields to the record"""
+        extra = {}
+        nested = getattr(self.__local, 'nested', 0.0)
+        start = time.perf_counter()
+        try:
+            yield extra
+        finally:
+            wall = time.perf_counter() - start
+            elapsed = wall - (getattr(self.__local, 'nested', 0.0) - nested)
+            self.record(kind, elapsed, wall=wall, **fields, **extra)
+
+    def timed_iter(self, iterable, kind, **fields):
+        """records the time spent producing the items of a lazy iterable and how many rows it made"""
+        if not self.enabled:
+            return iterable
+        return self.__timed_iter(iterable, kind, fields)
+
+    def __timed_iter(self, iterable, kind, fields):
+        """generator behind timed_iter, the consumer time is not counted"""
+        elapsed, rows = 0.0, 0
+        iterator = iter(iterable)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    step = time.perf_counter() - start
+                    elapsed += step
+                    self.__local.nested = getattr(self.__local, 'nested', 0.0) + step
+                rows += 1
+                yield item
+        finally:
+            self.record(kind, elapsed, rows=rows, **fields)
+
+    def get_records(self, kind=None):
+        """returns a copy of the records, optionally of one kind"""
+        with self.__lock:
+            return [r for r in self.__records if kind is None or r['kind'] == kind]
+
+    def get_report(self, top=REPORT_TOP):
+        """aggregates the records into report lines"""
+        records = self.get_records()
+        lines = []
+        if self.__started is not None:
+            lines.append(f'run wall time {time.perf_counter() - self.__started:.2f}s, {len(records)} records')
+
+        # latency distribution per kind
+        by_kind = defaultdict(list)
+        for record in records:
+            by_kind[record['kind']].append(record)
+        for kind,kind_records in by_kind.items():
+            elapsed = [r['elapsed'] for r in kind_records]
+            line = f'{kind:6} count {len(elapsed):6} total {sum(elapsed):9.2f}s p50 {percentile(elapsed, 50):7.3f}s p95 {percentile(elapsed, 95):7.3f}s p99 {percentile(elapsed, 99):7.3f}s'
+            totals = {k:sum(r.get(k, 0) or 0 for r in kind_records) for k in ['rows', 'bytes', 'retries']}
+            line += ''.join(f' {k} {v}' for k,v in totals.items() if v)
+            lines.append(line)
+
+        # where the time goes: fetch + parse + write per query name and per account
+        def slowest(key, title):
+            totals = defaultdict(float)
+            for record in records:
+                if record['kind'] in ['query', 'parse', 'write'] and record.get(key, None) is not None:
+                    totals[record[key]] += record['elapsed']
+            if totals:
+                lines.append(f'slowest {title}:')
+                for name,elapsed in sorted(totals.items(), key=lambda item: -item[1])[:top]:
+                    lines.append(f'    {elapsed:9.2f}s {name}')
+        slowest('query_name', 'queries')
+        slowest('account_id', 'accounts')
+
+        requests = sorted(by_kind.get('query', []), key=lambda r: -r['elapsed'])[:top]
+        if requests:
+            lines.append('slowest requests:')
+            for r in requests:
+                lines.append(f'    {r["elapsed"]:9.2f}s {r.get("account_id", "")} {r.get("query_name", "")} retries {r.get("retries", 0)}')
+        return lines
+
+
+# shared by the query client, the storages and the command line interface
+METRICS = Metrics()
@@ -3,14 +3,40 @@
 # version: 0.1
 #
 
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import copy
 import json
 import os
 import re
 import requests
+import time
+
+from instrumentation import METRICS
+from rate_limiter import backoff_delay, get_rate_limiter, THROTTLE_STATUS_CODES
 
 SP = '_'
 APDEX_FUNCTION_METRICS = ['count', 's', 't', 'f', 'score']
 MAX_RETRIES = 5
+# seconds after its end a window is closed, late events can still arrive before that
+CLOSED_WINDOW_LAG = 300
+POOL_SIZE = 10
+QUERY_API_URL = 'https://insights-api.newrelic.com'
+MAX_RESPONSE_PLANS = 256
+RESPONSE_PLANS = {}
+TIME_UNITS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400, 'week': 604800}
+SINCE_PATTERN = re.compile(r'\bsince\s+(?:(\d+)\s+([a-z]+?)s?\s+ago|(\d+))\b', re.IGNORECASE)
+UNTIL_PATTERN = re.compile(r'\buntil\s+(?:(\d+)\s+([a-z]+?)s?\s+ago|(\d+)|(now))\b', re.IGNORECASE)
+TIMESERIES_PATTERN = re.compile(r'\btimeseries\s+(\d+)\s+([a-z]+?)s?\b', re.IGNORECASE)
+SELECT_PATTERN = re.compile(r'\s*select\s+', re.IGNORECASE)
+FROM_PATTERN = re.compile(r'from\s', re.IGNORECASE)
+AGGREGATE_PATTERN = re.compile(r'([a-z]\w*)\s*\(.*\)(?:\s+as\s+(.+))?', re.IGNORECASE | re.DOTALL)
+UNMERGEABLE_PATTERN = re.compile(r'\b(?:facet|timeseries|compare\s+with)\b', re.IGNORECASE)
+ABSOLUTE_SINCE_PATTERN = re.compile(r'''\bsince\s+(?:\d+\b(?!\s+[a-z]+\s+ago)|'[^']*'|"[^"]*")''', re.IGNORECASE)
+ABSOLUTE_UNTIL_PATTERN = re.compile(r'''\buntil\s+(?:\d+\b(?!\s+[a-z]+\s+ago)|'[^']*'|"[^"]*")''', re.IGNORECASE)
+UNSPLITTABLE_PATTERN = re.compile(r'\b(?:facet|compare\s+with)\b', re.IGNORECASE)
+UNMERGEABLE_FUNCTIONS = ['keyset', 'eventtype', 'uniques']
+MAX_MERGED_FUNCTIONS = 20
 
 def msg(message, *args, stop=True, **kwargs):
     """lazy man log"""
@@ -19,6 +45,20 @@ def msg(message, *args, stop=True, **kwargs):
         exit(1)
 
 
+def new_session(pool_size=POOL_SIZE, adapter=None):
+    """returns a keep-alive requests session to be shared by all clients in a run
+
+    adapter can be any requests transport adapter (e.g. an HTTP/2 capable one),
+    otherwise a pooled HTTPAdapter with pool_size connections per host is used
+    """
+    if not adapter:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
 def to_datetime(timestamp):
     """converts a timestamp to a Sheets / Excel datetime"""
     EPOCH_START = 25569 # 1970-01-01 00:00:00
@@ -67,22 +107,28 @@ def get_results_header(contents, results):
                 header.append(name + SP + metric)
 
         elif function == 'events':
+            seen = set(header)
             for result in results:
                 for event in result['events']:
                     for key in event:
-                        if not key in header:
+                        if not key in seen:
+                            seen.add(key)
                             header.append(key)
 
         elif function == 'eventTypes':
+            seen = set(header)
             for result in results:
                 for event in result['eventTypes']:
-                    if not event in header:
+                    if not event in seen:
+                        seen.add(event)
                         header.append(event)
 
         elif function == 'keyset':
+            seen = set(header)
             for result in results:
                 for event in result['allKeys']:
-                    if not event in header:
+                    if not event in seen:
+                        seen.add(event)
                         header.append(event)
 
         else:
@@ -145,12 +191,95 @@ def get_results_values(results, header, include={}, offset=0):
     return values
 
 
-def get_single(results, header, include={}, offset=0):
+def compile_results_slot(result, names):
+    """returns a function copying one result slot to the names columns of a row"""
+    if 'percentiles' in result:
+        return lambda result, values: values.update(zip(names, result['percentiles'].values()))
+    elif 'histogram' in result:
+        return lambda result, values: values.update(zip(names, result['histogram']))
+    elif 'steps' in result:
+        return lambda result, values: values.update(zip(names, result['steps']))
+    elif 'eventTypes' in result:
+        return lambda result, values: values.update(zip(names, result['eventTypes']))
+    elif 'allKeys' in result:
+        return lambda result, values: values.update(zip(names, result['allKeys']))
+    elif 'score' in result:
+        return lambda result, values: values.update(zip(names, [result[metric] for metric in APDEX_FUNCTION_METRICS]))
+    else:
+        key, name = next(iter(result)), names[0]
+        def copy_value(result, values):
+            values[name] = result[key]
+        return copy_value
+
+
+class ResultsExtractor():
+    """ results values extraction compiled from the first row and reused for all the others
+
+        each result slot is mapped once to its columns and a direct accessor, so rows are
+        parsed without probing keys; rows not matching the compiled plan fall back to
+        get_results_values
+    """
+
+    def __init__(self, header, offset):
+        """init"""
+        self.__header = header
+        self.__offset = offset
+        self.__slots = None
+
+    def __compile(self, results):
+        """map each result slot to a column range of the header"""
+        slots = []
+        index = self.__offset
+        for result in results:
+            if 'percentiles' in result:
+                width = len(result['percentiles'])
+            elif 'histogram' in result:
+                width = len(result['histogram'])
+            elif 'steps' in result:
+                width = len(result['steps'])
+            elif 'eventTypes' in result:
+                width = len(result['eventTypes'])
+            elif 'allKeys' in result:
+                width = len(result['allKeys'])
+            elif 'score' in result:
+                width = len(APDEX_FUNCTION_METRICS)
+            else:
+                width = 1
+            slots.append(compile_results_slot(result, self.__header[index:index+width]))
+            index += width
+        return slots
+
+    def __call__(self, results, values):
+        """copy the results values to the values dict"""
+        try:
+            if self.__slots is None:
+                self.__slots = self.__compile(results)
+            if len(results) != len(self.__slots):
+                raise KeyError
+            for slot,result in zip(self.__slots, results):
+                slot(result, values)
+        except (KeyError, TypeError, StopIteration):
+            values.update(get_results_values(results, self.__header, {}, self.__offset))
+        return values
+
+
+def get_results_extractor(header, offset, plans=None):
+    """returns the extractor for this header, shared through plans when given"""
+    if plans is None:
+        return ResultsExtractor(header, offset)
+    key = (offset, tuple(header[offset:]))
+    if not key in plans:
+        plans[key] = ResultsExtractor(header, offset)
+    return plans[key]
+
+
+def get_single(results, header, include={}, offset=0, plans=None):
     """ SELECT aggr1, aggr2, ... FROM ... """
-    yield get_results_values(results, header, include, offset)
+    extract = get_results_extractor(header, offset, plans)
+    yield extract(results, {k:v for k,v in include.items()})
 
 
-def get_events(results, header, include={}, offset=0):
+def get_events(results, header, include={}, offset=0, plans=None):
     """ SELECT attr1, attr2, ... FROM ... """
     events = results[0]['events']
     for event in events:
@@ -159,77 +288,569 @@ def get_events(results, header, include={}, offset=0):
         yield row
 
 
-def get_facets(results, header, include={}, offset=0):
+def get_facets(results, header, include={}, offset=0, plans=None):
     """ SELECT aggr1, aggr2, ... FROM ... FACET attr1, attr2, ... """
+    extract = get_results_extractor(header, offset, plans)
+    facets_header = header[len(include):]
     for result in results:
-        row = {k:v for k,v in include.items()}
-        row.update(get_facets_values(result['name'], header[len(include):]))
-        row.update(get_results_values(result['results'], header, {}, offset))
-        yield row
+        row = include.copy()
+        row.update(get_facets_values(result['name'], facets_header))
+        yield extract(result['results'], row)
 
 
-def get_timeseries(results, header, include={}, offset=0, prefix=''):
+def get_timeseries(results, header, include={}, offset=0, prefix='', plans=None):
     """ SELECT aggr1, aggr2, ... FROM ... TIMESERIES """
+    extract = get_results_extractor(header, offset, plans)
+    datetime, timestamp = 'datetime' + prefix, 'timestamp' + prefix
+    timewindow, inspected_count = 'timewindow' + prefix, 'inspectedCount' + prefix
     for result in results:
-        row = {k:v for k,v in include.items()}
-        row.update({
-            'datetime' + prefix: to_datetime(int(result['endTimeSeconds'])),
-            'timestamp' + prefix: result['endTimeSeconds'],
-            'timewindow' + prefix: result['endTimeSeconds'] - result['beginTimeSeconds'],
-            'inspectedCount' + prefix: result['inspectedCount']
-        })
-        row.update(get_results_values(result['results'], header, {}, offset))
-        yield row
+        row = include.copy()
+        end_time = result['endTimeSeconds']
+        row[datetime] = to_datetime(int(end_time))
+        row[timestamp] = end_time
+        row[timewindow] = end_time - result['beginTimeSeconds']
+        row[inspected_count] = result['inspectedCount']
+        yield extract(result['results'], row)
 
 
-def get_facets_timeseries(results, header, include={}, offset=0):
+def get_facets_timeseries(results, header, include={}, offset=0, plans=None):
     """ SELECT aggr1(), aggr2(), ... FROM ... FACET attr1, attr2, ... TIMESERIES """
+    plans = {} if plans is None else plans
+    facets_header = header[len(include):]
     for result in results:
-        row = {k:v for k,v in include.items()}
-        row.update(get_facets_values(result['name'], header[len(include):]))
-        for timeseries in get_timeseries(result['timeSeries'], header, row, offset):
+        row = include.copy()
+        row.update(get_facets_values(result['name'], facets_header))
+        for timeseries in get_timeseries(result['timeSeries'], header, row, offset, plans=plans):
             yield timeseries
 
 
-def get_compare(results, header, include={}, offset=0):
+def get_compare(results, header, include={}, offset=0, plans=None):
     """ SELECT aggr1(), aggr2(), ... FROM ... COMPARE WITH ... """
     current = results['current']['results']
     previous = results['previous']['results']
     header_previous = [v if i < offset else v + '_compare' for i,v in enumerate(header)]
     row = {k:v for k,v in include.items()}
-    row.update(get_results_values(current, header, {}, offset))
-    row.update(get_results_values(previous, header_previous, {}, offset))
+    get_results_extractor(header, offset, plans)(current, row)
+    get_results_extractor(header_previous, offset, plans)(previous, row)
     yield row
 
 
-def get_compare_facets(results, header, include={}, offset=0):
+def get_compare_facets(results, header, include={}, offset=0, plans=None):
     """ SELECT aggr1(), aggr2(), ... FROM ... COMPARE WITH ... FACET attr1, attr2, ... """
     facets_current = results['current']['facets']
     facets_previous = results['previous']['facets']
     header_previous = [v if i < offset else v + '_compare' for i,v in enumerate(header)]
     facets_curr_prev = zip(
-        get_facets(facets_current, header, include, offset),
-        get_facets(facets_previous, header_previous, include, offset)
+        get_facets(facets_current, header, include, offset, plans),
+        get_facets(facets_previous, header_previous, include, offset, plans)
     )
     for curr,prev in facets_curr_prev:
         curr.update(prev)
         yield curr
 
 
-def get_compare_timeseries(results, header, include={}, offset=0):
+def get_compare_timeseries(results, header, include={}, offset=0, plans=None):
     """ SELECT aggr1(), aggr2(), ... FROM ... COMPARE WITH ... TIMESERIES """
     timeseries_current = results['current']['timeSeries']
     timeseries_previous = results['previous']['timeSeries']
     header_previous = [v if i < offset else v + '_compare' for i,v in enumerate(header)]
     timeseries_curr_prev = zip(
-        get_timeseries(timeseries_current, header, include, offset),
-        get_timeseries(timeseries_previous, header_previous, include, offset, '_compare')
+        get_timeseries(timeseries_current, header, include, offset, plans=plans),
+        get_timeseries(timeseries_previous, header_previous, include, offset, '_compare', plans)
     )
     for curr,prev in timeseries_curr_prev:
         curr.update(prev)
         yield curr
 
 
+class ResponsePlan():
+    """ everything parse_response derives from the response metadata, compiled once per shape
+
+        - NRQL structure flags, facets names and the parsing function
+        - the results part of the header, unless it depends on the data (events, keyset, ...)
+        - the results extractors shared by every response with the same shape
+    """
+
+    DYNAMIC_FUNCTIONS = ['events', 'eventTypes', 'keyset']
+
+    def __init__(self, metadata):
+        """init"""
+        contents = metadata['contents']
+
+        # determine the NRQL structure
+        has_compare = 'compareWith' in metadata
+        has_facets = 'facet' in metadata or 'facet' in contents
+        has_timeseries = 'timeSeries' in metadata or 'timeSeries' in contents
+        is_simple = not has_compare and not has_facets and not has_timeseries
+        has_events = is_simple and len(contents) and 'order' in contents[0]
+        has_single = is_simple and len(contents) and not 'order' in contents[0]
+        self.has_compare = has_compare
+
+        # get facets attribute names
+        if has_facets:
+            if has_compare:
+                self.facet = contents['facet']
+            else:
+                self.facet = metadata['facet']
+        else:
+            self.facet = None
+
+        # normalize the contents list
+        if has_timeseries and (has_compare or has_facets):
+            contents = contents['timeSeries']['contents']
+        elif has_timeseries and not (has_compare or has_facets):
+            contents = metadata['timeSeries']['contents']
+        elif has_compare and has_facets:
+            contents = contents['contents']['contents']
+        elif has_compare or has_facets:
+            contents = contents['contents']
+        else:
+            contents = metadata['contents']
+        self.contents = contents
+
+        # select the proper parsing function and results attributes
+        if has_single:
+            self.fetch_data, self.results_keys = get_single, 'results'
+        elif has_events:
+            self.fetch_data, self.results_keys = get_events, 'results'
+        elif has_compare:
+            if has_facets:
+                self.fetch_data = get_compare_facets
+            elif has_timeseries:
+                self.fetch_data = get_compare_timeseries
+            else:
+                self.fetch_data = get_compare
+            self.results_keys = ['current', 'previous']
+        elif has_facets:
+            if has_timeseries:
+                self.fetch_data = get_facets_timeseries
+            else:
+                self.fetch_data = get_facets
+            self.results_keys = 'facets'
+        elif has_timeseries:
+            self.fetch_data, self.results_keys = get_timeseries, 'timeSeries'
+        else:
+            self.fetch_data, self.results_keys = None, None
+
+        # data independent header can be built once
+        functions = [content.get('contents', content).get('function', '') for content in contents]
+        if any(function in ResponsePlan.DYNAMIC_FUNCTIONS for function in functions):
+            self.results_header = None
+        else:
+            self.results_header = get_results_header(contents, [])
+        self.plans = {}
+
+    def get_results(self, response):
+        """returns the results attribute(s) parsed by fetch_data"""
+        if type(self.results_keys) is list:
+            return {k:response[k] for k in self.results_keys}
+        return response[self.results_keys] if self.results_keys else []
+
+    def get_results_header(self, results):
+        """returns the results part of the header"""
+        if self.results_header is None:
+            return get_results_header(self.contents, results)
+        return self.results_header
+
+
+def get_response_plan(metadata):
+    """returns the cached plan for the metadata shape, compiling it on a miss"""
+    key = json.dumps([
+        metadata.get('contents'),
+        metadata.get('facet'),
+        metadata.get('timeSeries', {}).get('contents'),
+        'compareWith' in metadata
+    ], sort_keys=True)
+    plan = RESPONSE_PLANS.get(key, None)
+    if not plan:
+        if len(RESPONSE_PLANS) >= MAX_RESPONSE_PLANS:
+            RESPONSE_PLANS.clear()
+        plan = RESPONSE_PLANS[key] = ResponsePlan(metadata)
+    return plan
+
+
+def prepare_response(response, include={}):
+    """returns the plan and (results, header, meta, offset) arguments of its fetch_data, None if unparseable"""
+    try:
+        metadata = response['metadata']
+        plan = get_response_plan(metadata)
+    except:
+        return None
+    if not plan.fetch_data:
+        return None
+
+    # precalculate timestamps and add here to enforce sort order
+    # they get overwritten later on if NRQL has a timeseries clause
+    begintime = int(metadata.get('beginTimeMillis', 0) / 1000)
+    timestamp = int(metadata.get('endTimeMillis', 0) / 1000)
+    timewindow = timestamp - begintime
+    compare_delta = int(metadata.get('compareWith', 0) / 1000)
+    timestamp_compare = timestamp - compare_delta
+    datetime = to_datetime(timestamp)
+    datetime_compare = to_datetime(timestamp_compare)
+    if not compare_delta:
+        meta = {
+            'datetime': datetime,
+            'timewindow': timewindow,
+            'timestamp': timestamp
+        }
+    else:
+        meta = {
+            'datetime': datetime,
+            'datetime_compare': datetime_compare,
+            'timewindow': timewindow,
+            'timestamp': timestamp,
+            'timestamp_compare': timestamp_compare
+        }
+
+    results = plan.get_results(response)
+
+    # build the header and meta dictionary
+    meta, _meta = {}, meta
+    header = []
+    for k,v in include.items():
+        header.append(k)
+        meta[k] = v
+    for k,v in _meta.items():
+        header.append(k)
+        meta[k] = v
+    offset = len(header)
+    facet = plan.facet
+    if type(facet) is list:
+        header.extend(facet)
+        offset += len(facet)
+    elif type(facet) is str:
+        header.append(facet)
+        offset += 1
+    header.extend(plan.get_results_header(results))
+    return plan, (results, header, meta, offset)
+
+
+def parse_response(response, include={}):
+    """convert a Query API JSON response to an events generator"""
+    prepared = prepare_response(response, include)
+    if not prepared:
+        return
+    plan, arguments = prepared
+
+    # parse the result JSON and yield events
+    for event in plan.fetch_data(*arguments, plans=plan.plans):
+        yield event
+
+
+class Rows():
+    """ row oriented result set: a header tuple and an iterator of row tuples
+
+        rows are produced lazily, only the first event is read upfront to get the header
+    """
+
+    def __init__(self, events=[], header=None):
+        """init from an iterable of events dictionaries, or of row tuples when header is given"""
+        events = iter(events)
+        if header is None:
+            first = next(events, None)
+            self.header = tuple(first.keys()) if first else ()
+        else:
+            first = None
+            self.header = tuple(header)
+        self.__first = first
+        self.__events = events
+        self.__is_tuples = header is not None
+
+    def __iter__(self):
+        """yields one tuple per event, columns follow the header order"""
+        if self.__is_tuples:
+            yield from self.__events
+            return
+        if self.__first is None:
+            return
+        header, width = self.header, len(self.header)
+        yield tuple(self.__first.values())
+        self.__first = None
+        for event in self.__events:
+            # same parser, same keys order, no need to look up every key
+            if len(event) == width:
+                yield tuple(event.values())
+            else:
+                yield tuple(event.get(k, None) for k in header)
+
+    def dicts(self):
+        """yields the rows back as events dictionaries"""
+        for row in self:
+            yield dict(zip(self.header, row))
+
+    @staticmethod
+    def from_data(data):
+        """accepts Rows, Columns or any iterable of events dictionaries"""
+        if isinstance(data, Rows):
+            return data
+        if isinstance(data, Columns):
+            return data.rows()
+        return Rows(data)
+
+
+class Columns():
+    """ column oriented result set, all numeric columns are stored in typed arrays """
+
+    def __init__(self, data=[]):
+        """init from Rows or any iterable of events dictionaries"""
+        rows = Rows.from_data(data)
+        self.header = rows.header
+        columns = tuple([] for _ in self.header)
+        for row in rows:
+            for column,value in zip(columns, row):
+                column.append(value)
+        self.columns = {k:self.__compact(v) for k,v in zip(self.header, columns)}
+
+    def __compact(self, values):
+        """converts all int (q) or all int/float (d) lists to arrays"""
+        types = set(type(value) for value in values)
+        if types == {int}:
+            try:
+                return array('q', values)
+            except OverflowError:
+                return values
+        if types and types <= {int, float}:
+            return array('d', values)
+        return values
+
+    def __len__(self):
+        """number of rows"""
+        return len(self.columns[self.header[0]]) if self.header else 0
+
+    def rows(self):
+        """returns a Rows view of the columns"""
+        return Rows(zip(*self.columns.values()), self.header)
+
+
+def parse_rows(response, include={}):
+    """convert a Query API JSON response to Rows"""
+    return Rows(METRICS.timed_iter(parse_response(response, include), 'parse'))
+
+
+def get_clause_seconds(match, now):
+    """converts a SINCE/UNTIL clause match to epoch seconds, None if unsupported"""
+    if not match:
+        return None
+    count, unit, epoch = match.group(1), match.group(2), match.group(3)
+    if epoch:
+        epoch = int(epoch)
+        return epoch / 1000 if epoch > 10**11 else epoch # NRQL takes both ms and s
+    if count and unit.lower() in TIME_UNITS:
+        return now - int(count) * TIME_UNITS[unit.lower()]
+    if match.lastindex == 4: # UNTIL NOW
+        return now
+    return None
+
+
+def mask_quoted(nrql):
+    """blanks the contents of quoted strings, so clause patterns only match the nrql itself at the same positions"""
+    masked, quote = [], None
+    for c in nrql:
+        if quote:
+            quote = None if c == quote else quote
+            masked.append(c if not quote else ' ')
+        else:
+            quote = c if c in '\'"`' else None
+            masked.append(c)
+    return ''.join(masked)
+
+
+def split_time_window(nrql, windows, now=None):
+    """ split the SINCE/UNTIL range of a nrql into windows consecutive nrqls
+
+        only relative (N units ago) and epoch clauses are supported, any other
+        form returns the nrql unchanged; sub-windows are aligned to the
+        TIMESERIES bucket size, a TIMESERIES without an explicit N unit bucket
+        is not split as every sub-window would get its own automatic bucket size;
+        FACET and COMPARE WITH results cannot be stitched and are never split,
+        quoted strings are left alone
+    """
+    now = int(now if now else time.time())
+    masked = mask_quoted(nrql)
+    if windows < 2 or UNSPLITTABLE_PATTERN.search(masked):
+        return [nrql]
+    since_match = SINCE_PATTERN.search(masked)
+    until_match = UNTIL_PATTERN.search(masked)
+    since = get_clause_seconds(since_match, now)
+    until = get_clause_seconds(until_match, now) if until_match else now
+    if since is None or until is None or until <= since:
+        return [nrql]
+    if re.search(r'\buntil\b', masked, re.IGNORECASE) and not until_match:
+        return [nrql]
+
+    bucket_match = TIMESERIES_PATTERN.search(masked)
+    if re.search(r'\btimeseries\b', masked, re.IGNORECASE) and not (bucket_match and bucket_match.group(2).lower() in TIME_UNITS):
+        return [nrql]
+
+    step = -(-(until - since) // windows)
+    if bucket_match:
+        bucket = int(bucket_match.group(1)) * TIME_UNITS[bucket_match.group(2).lower()]
+        step = max(bucket, -(-step // bucket) * bucket)
+
+    # strip the original clauses, the rest of the nrql is kept as is
+    for match in sorted([m for m in [since_match, until_match] if m], key=lambda m: m.start(), reverse=True):
+        nrql = nrql[:match.start()] + nrql[match.end():]
+    nrql = nrql.rstrip()
+
+    split_nrqls = []
+    start = since
+    while start < until:
+        end = min(start + step, until)
+        split_nrqls.append(f'{nrql} SINCE {int(start * 1000)} UNTIL {int(end * 1000)}')
+        start = end
+    return split_nrqls
+
+
+def merge_responses(responses):
+    """ stitch the responses of a split nrql into a single response
+
+        only event lists and plain timeseries can be stitched, returns None otherwise
+    """
+    try:
+        merged = copy.deepcopy(responses[0])
+        metadata = merged['metadata']
+        contents = metadata['contents']
+        if 'compareWith' in metadata or 'facet' in metadata or 'facet' in contents:
+            return None
+        if 'timeSeries' in metadata:
+            key = 'timeSeries'
+        elif len(contents) and 'order' in contents[0]:
+            key = 'events'
+        else:
+            return None
+        for response in responses[1:]:
+            if key == 'timeSeries':
+                merged['timeSeries'].extend(response['timeSeries'])
+            else:
+                merged['results'][0]['events'].extend(response['results'][0]['events'])
+        metadata['beginTimeMillis'] = min(r['metadata'].get('beginTimeMillis', 0) for r in responses)
+        metadata['endTimeMillis'] = max(r['metadata'].get('endTimeMillis', 0) for r in responses)
+        return merged
+    except (IndexError, KeyError, TypeError):
+        return None
+
+
+def parse_nrql(nrql, params, logger=None):
+    """ replace variables in nrql """
+    pattern = re.compile(r'\{[a-zA-Z][\w]*}')
+    for var in pattern.findall(nrql):
+        param = var[1:-1]
+        try:
+            nrql = nrql.replace(var, str(params[param]))
+        except:
+            if logger:
+                logger('warning: cannot find {} in parameters dictionary', param, stop=False)
+    return nrql
+
+
+def split_select(nrql):
+    """ splits a single value 'select f(x), g(y) as b from ...' nrql into its functions and the rest
+
+        returns None unless every selected item is an aggregate function and the
+        rest has no FACET, TIMESERIES or COMPARE WITH clause
+    """
+    match = SELECT_PATTERN.match(nrql)
+    if not match:
+        return None
+    functions, depth, quote, start = [], 0, None, match.end()
+    for i in range(start, len(nrql)):
+        c = nrql[i]
+        if quote:
+            quote = None if c == quote else quote
+        elif c in '\'"`':
+            quote = c
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif depth == 0 and c == ',':
+            functions.append(nrql[start:i].strip())
+            start = i + 1
+        elif depth == 0 and nrql[i-1].isspace() and FROM_PATTERN.match(nrql, i):
+            functions.append(nrql[start:i].strip())
+            rest = nrql[i:].strip()
+            break
+    else:
+        return None
+    if UNMERGEABLE_PATTERN.search(rest):
+        return None
+    for function in functions:
+        match = AGGREGATE_PATTERN.fullmatch(function)
+        if not match or match.group(1).lower() in UNMERGEABLE_FUNCTIONS:
+            return None
+    return functions, rest
+
+
+def merge_nrqls(nrqls, max_functions=MAX_MERGED_FUNCTIONS):
+    """ groups single value nrqls sharing the same FROM ... rest into one multi function nrql
+
+        returns a list of (nrql, [(index, start, stop), ...]) where [start:stop] are the
+        contents and results of nrqls[index] in the merged response, start is None when
+        the nrql is sent as is; groups are sorted by their first index
+    """
+    groups, open_groups = [], {}
+    for index,nrql in enumerate(nrqls):
+        selected = split_select(nrql)
+        if not selected:
+            groups.append([None, [nrql], [(index, None, None)], set()])
+            continue
+        functions, rest = selected
+        names = {(AGGREGATE_PATTERN.fullmatch(function).group(2) or function).strip().lower() for function in functions}
+        key = ' '.join(rest.split()).lower()
+        group = open_groups.get(key, None)
+        # the same function or alias twice in one select would make the results ambiguous
+        if group and (len(group[1]) + len(functions) > max_functions or names & group[3]):
+            group = None
+        if not group:
+            group = open_groups[key] = [rest, [], [], set()]
+            groups.append(group)
+        group[2].append((index, len(group[1]), len(group[1]) + len(functions)))
+        group[1].extend(functions)
+        group[3].update(names)
+
+    merged = []
+    for rest,functions,members,_ in groups:
+        if rest is None or len(members) == 1:
+            merged.extend((nrqls[index], [(index, None, None)]) for index,_,_ in members)
+        else:
+            merged.append((f'select {", ".join(functions)} {rest}', members))
+    return merged
+
+
+def get_end_time(response):
+    """returns the end of the window of a response in epoch seconds, None if it failed"""
+    try:
+        return int(response['metadata']['endTimeMillis'] / 1000)
+    except (KeyError, TypeError):
+        return None
+
+
+def has_absolute_window(nrql):
+    """true if both SINCE and UNTIL are epoch or datetime values, relative windows shift between runs"""
+    masked = mask_quoted(nrql)
+    return bool(ABSOLUTE_SINCE_PATTERN.search(masked) and ABSOLUTE_UNTIL_PATTERN.search(masked))
+
+
+def is_window_closed(response, request_time):
+    """true if the response window ended CLOSED_WINDOW_LAG seconds before the request, its results cannot change"""
+    end_time = get_end_time(response)
+    return end_time is not None and end_time <= request_time - CLOSED_WINDOW_LAG
+
+
+def split_response(response, start, stop):
+    """returns the response of the functions [start:stop] of a merged response, None if it does not fit"""
+    try:
+        contents = response['metadata']['contents']
+        results = response['results']
+        if type(contents) is not list or len(contents) != len(results) or stop > len(results):
+            return None
+        metadata = {**response['metadata'], 'contents': contents[start:stop]}
+        return {**response, 'metadata': metadata, 'results': results[start:stop]}
+    except (KeyError, TypeError):
+        return None
+
+
 class NewRelicQueryAPI():
     """ interface to New Relic Query API that always returns a list of events
 
@@ -275,9 +896,16 @@ class NewRelicQueryAPI():
                 - analysis range is [timestamp - timewindows : timestamp]
     """
 
-    def __init__(self, account_id=0, query_api_key='', logger=msg):
-        """init"""
+    def __init__(self, account_id=0, query_api_key='', logger=msg, session=None, cache=None, rate_limit=0, concurrency=None):
+        """init
+
+            rate_limit caps requests per second, shared by all clients with the same key
+            concurrency is an AdaptiveConcurrency controller shared by all clients in a run
+        """
         self.__logger = logger
+        self.__session = session if session else new_session()
+        self.__cache = cache
+        self.__concurrency = concurrency
         if not account_id:
             account_id = os.getenv('NEW_RELIC_ACCOUNT_ID', '')
         if not account_id:
@@ -290,166 +918,121 @@ class NewRelicQueryAPI():
             'Accept': 'application/json',
             'X-Query-Key': query_api_key
         }
-        self.__url = f'https://insights-api.newrelic.com/v1/accounts/{account_id}/query'
-
-    def __parse_nrql(self, nrql, params):
-        """ replace variables in nrql """
-        pattern = re.compile(r'\{[a-zA-Z][\w]*}')
-        for var in pattern.findall(nrql):
-            param = var[1:-1]
-            try:
-                nrql = nrql.replace(var, str(params[param]))
-            except:
-                self.__logger(
-                    'warning: cannot find {} in parameters dictionary', param, stop=False)
-        return nrql
+        self.__rate_limiter = get_rate_limiter(query_api_key, rate_limit)
+        self.__account_id = account_id
+        # env NEW_RELIC_QUERY_API_URL points the client to another endpoint (e.g. a mock server)
+        query_api_url = os.getenv('NEW_RELIC_QUERY_API_URL', QUERY_API_URL).rstrip('/')
+        self.__url = f'{query_api_url}/v1/accounts/{account_id}/query'
+
+    def query(self, nrql, params={}, max_retries=MAX_RETRIES, windows=1):
+        """request a JSON result from the Insights Query API
+
+            windows > 1 splits the SINCE/UNTIL range and fetches the sub-windows in parallel
+        """
+        parsed_nrql = parse_nrql(nrql, params, self.__logger)
+        if windows > 1:
+            split_nrqls = split_time_window(parsed_nrql, windows)
+            if len(split_nrqls) < 2:
+                self.__logger('warning: cannot split the time window of {}', parsed_nrql, stop=False)
+            else:
+                with ThreadPoolExecutor(max_workers=len(split_nrqls)) as executor:
+                    responses = list(executor.map(METRICS.bind(lambda n: self.__query(n, max_retries)), split_nrqls))
+                if not all(responses):
+                    self.__logger('warning: a sub-window of {} failed, fetching the whole window', parsed_nrql, stop=False)
+                else:
+                    response = merge_responses(responses)
+                    if response is not None:
+                        return response
+                    self.__logger('warning: cannot merge the sub-window results of {}, fetching the whole window', parsed_nrql, stop=False)
+        return self.__query(parsed_nrql, max_retries)
+
+    def query_many(self, nrqls, params={}, max_retries=MAX_RETRIES):
+        """ request the JSON results of several nrqls, merging single value selects into one request
+
+            a merged request that fails or cannot be split back is retried one nrql at a time
+        """
+        parsed_nrqls = [parse_nrql(nrql, params, self.__logger) for nrql in nrqls]
+        responses = [None] * len(nrqls)
+        for nrql,members in merge_nrqls(parsed_nrqls):
+            response = self.__query(nrql, max_retries)
+            for index,start,stop in members:
+                if start is None:
+                    responses[index] = response
+                else:
+                    responses[index] = split_response(response, start, stop) if response else None
+            if any(responses[index] is None for index,_,_ in members):
+                self.__logger('warning: merged query failed, running its queries one by one', stop=False)
+                for index,_,_ in members:
+                    responses[index] = self.__query(parsed_nrqls[index], max_retries)
+        return responses
+
+    def __query(self, parsed_nrql, max_retries=MAX_RETRIES):
+        """request a JSON result for an already parsed nrql"""
+        with METRICS.timer('query') as metrics:
+            results = self.__fetch(parsed_nrql, max_retries, metrics)
+        return results
 
-    def query(self, nrql, params={}, max_retries=MAX_RETRIES):
-        """request a JSON result from the Insights Query API"""
-        parsed_nrql = self.__parse_nrql(nrql, params)
+    def __fetch(self, parsed_nrql, max_retries, metrics):
+        """cache lookup and retry loop behind __query, metrics collects bytes, retries and status"""
+        # only absolute windows are cached, the same relative nrql means another window on every run
+        cache = self.__cache if self.__cache and has_absolute_window(parsed_nrql) else None
+        if cache:
+            results = cache.get(self.__account_id, parsed_nrql)
+            if results is not None:
+                metrics['cached'] = True
+                return results
+        # recent windows can still receive late events and are not cached yet
+        request_time = time.time()
         count_retries = 0
-        status_code = 0
-        while True:
+        while count_retries < max_retries:
+            count_retries += 1
+            if self.__rate_limiter:
+                self.__rate_limiter.acquire()
+            if self.__concurrency:
+                self.__concurrency.acquire()
+            throttled, retry_after = False, None
+            metrics['retries'] = count_retries - 1
             try:
-                count_retries += 1
-                response = requests.get(
+                response = self.__session.get(
                     self.__url, headers=self.__headers, params={'nrql': parsed_nrql})
-                status_code = response.status_code
+                status_code = metrics['status'] = response.status_code
                 if status_code == 200:
+                    metrics['bytes'] = len(response.content)
                     results = response.json()
-                    break
-                else:
-                    self.__logger(
-                        'warning: got a {} response fetching {} ({}/{})',
-                        status_code, self.__url, count_retries, max_retries, stop=False)
+                    if cache and is_window_closed(results, request_time):
+                        cache.put(self.__account_id, parsed_nrql, results)
+                    return results
+                throttled = status_code in THROTTLE_STATUS_CODES
+                retry_after = response.headers.get('Retry-After', None)
+                self.__logger(
+                    'warning: got a {} response fetching {} ({}/{})',
+                    status_code, self.__url, count_retries, max_retries, stop=False)
             except requests.RequestException:
-                if count_retries >= max_retries:
-                    break
+                pass
             finally:
-                if count_retries >= max_retries and status_code != 200:
-                    self.__logger(
-                        'warning: gave up fetching {} after {} attempts',
-                        self.__url, max_retries, stop=False)
-                    results = []
-                    break
+                if self.__concurrency:
+                    self.__concurrency.release(throttled)
+            if count_retries < max_retries:
+                time.sleep(backoff_delay(count_retries, retry_after))
 
-        return results
+        self.__logger(
+            'warning: gave up fetching {} after {} attempts',
+            self.__url, max_retries, stop=False)
+        return []
 
-    def events(self, nrql, include={}, params={}):
+    def events(self, nrql, include={}, params={}, windows=1):
         """execute the nrql and convert to an events list"""
-        response = self.query(nrql, params=params)
-        try:
-            metadata = response['metadata']
-            contents = metadata['contents']
-        except:
-            return
-
-        # determine the NRQL structure
-        has_compare = 'compareWith' in metadata
-        has_facets = 'facet' in metadata or 'facet' in contents
-        has_timeseries = 'timeSeries' in metadata or 'timeSeries' in contents
-        is_simple = not has_compare and not has_facets and not has_timeseries
-        has_events = is_simple and len(contents) and 'order' in contents[0]
-        has_single = is_simple and len(contents) and not 'order' in contents[0]
-
-        # get facets attribute names
-        if has_facets:
-            if has_compare:
-                facet = contents['facet']
-            else:
-                facet = metadata['facet']
-        else:
-            facet = None
-
-        # normalize the contents list
-        if has_timeseries and (has_compare or has_facets):
-            contents = contents['timeSeries']['contents']
-        elif has_timeseries and not (has_compare or has_facets):
-            contents = metadata['timeSeries']['contents']
-        elif has_compare and has_facets:
-            contents = contents['contents']['contents']
-        elif has_compare or has_facets:
-            contents = contents['contents']
-        else:
-            contents = metadata['contents']
-
-        # precalculate timestamps and add here to enforce sort order
-        # they get overwritten later on if NRQL has a timeseries clause
-        begintime = int(metadata.get('beginTimeMillis', 0) / 1000)
-        timestamp = int(metadata.get('endTimeMillis', 0) / 1000)
-        timewindow = timestamp - begintime
-        compare_delta = int(metadata.get('compareWith', 0) / 1000)
-        timestamp_compare = timestamp - compare_delta
-        datetime = to_datetime(timestamp)
-        datetime_compare = to_datetime(timestamp_compare)
-        if not compare_delta:
-            meta = {
-                'datetime': datetime,
-                'timewindow': timewindow,
-                'timestamp': timestamp
-            }
-        else:
-            meta = {
-                'datetime': datetime,
-                'datetime_compare': datetime_compare,
-                'timewindow': timewindow,
-                'timestamp': timestamp,
-                'timestamp_compare': timestamp_compare
-            }
-
-        # select the proper parsing function and parameters
-        if has_single:
-            fetch_data = get_single
-            results = response['results']
-
-        elif has_events:
-            fetch_data = get_events
-            results = response['results']
-
-        elif has_compare:
-            if has_facets:
-                fetch_data = get_compare_facets
-            elif has_timeseries:
-                fetch_data = get_compare_timeseries
-            else:
-                fetch_data = get_compare
-            results = {k:response[k] for k in ['current', 'previous']}
-
-        elif has_facets:
-            if has_timeseries:
-                fetch_data = get_facets_timeseries
-            else:
-                fetch_data = get_facets
-            results = response['facets']
+        response = self.query(nrql, params=params, windows=windows)
+        for event in METRICS.timed_iter(parse_response(response, include), 'parse'):
+            yield event
 
-        elif has_timeseries:
-            fetch_data = get_timeseries
-            results = response['timeSeries']
+    def rows(self, nrql, include={}, params={}, windows=1):
+        """execute the nrql and convert to Rows (header + row tuples)"""
+        return Rows(self.events(nrql, include, params, windows))
 
-        else:
-            results = []
-
-        # build the header and meta dictionary
-        meta, _meta = {}, meta
-        header = []
-        for k,v in include.items():
-            header.append(k)
-            meta[k] = v
-        for k,v in _meta.items():
-            header.append(k)
-            meta[k] = v
-        offset = len(header)
-        if type(facet) is list:
-            header.extend(facet)
-            offset += len(facet)
-        elif type(facet) is str:
-            header.append(facet)
-            offset += 1
-        header.extend(get_results_header(contents, results))
-
-        # parse the result JSON and yield events
-        for event in fetch_data(results, header, meta, offset):
-            yield event
+    def columns(self, nrql, include={}, params={}, windows=1):
+        """execute the nrql and convert to Columns (one list or array per attribute)"""
+        return Columns(self.rows(nrql, include, params, windows))
 
 # run all test cases
 if __name__ == "__main__":
@@ -0,0 +1,208 @@
+#
+# author: Paulo Monteiro
+# version: 0.1
+#
+
+import asyncio
+import os
+import time
+
+import aiohttp
+
+from instrumentation import METRICS
+from newrelic_query_api import (msg, has_absolute_window, is_window_closed, merge_nrqls, merge_responses, parse_nrql, parse_response,
+    split_response, split_time_window, Columns, Rows, MAX_RETRIES, POOL_SIZE, QUERY_API_URL)
+from rate_limiter import backoff_delay, get_rate_limiter, THROTTLE_STATUS_CODES
+
+CONCURRENCY = 100
+
+
+def new_async_session(pool_size=POOL_SIZE):
+    """returns an aiohttp session with a keep-alive connection pool of pool_size, needs a running loop"""
+    connector = aiohttp.TCPConnector(limit=pool_size, limit_per_host=pool_size)
+    return aiohttp.ClientSession(connector=connector)
+
+
+class AsyncNewRelicQueryAPI():
+    """ asyncio interface to New Relic Query API, see NewRelicQueryAPI
+
+        - query, query_many and events have the same semantics and row shapes as NewRelicQueryAPI
+        - a session and a semaphore shared by many clients bound the connections and requests
+          in flight, so one event loop can run thousands of account queries
+        - without a session one is created on the first request and released by close()
+    """
+
+    def __init__(self, account_id=0, query_api_key='', logger=msg, session=None, cache=None, rate_limit=0, semaphore=None):
+        """init
+
+            rate_limit caps requests per second, shared by all clients with the same key
+            semaphore bounds the requests in flight, shared by all clients in a run
+        """
+        self.__logger = logger
+        self.__session = session
+        self.__own_session = session is None
+        self.__cache = cache
+        self.__semaphore = semaphore if semaphore else asyncio.Semaphore(CONCURRENCY)
+        if not account_id:
+            account_id = os.getenv('NEW_RELIC_ACCOUNT_ID', '')
+        if not account_id:
+            self.__logger('account id not provided and env NEW_RELIC_ACCOUNT_ID not set')
+        if not query_api_key:
+            query_api_key = os.getenv('NEW_RELIC_QUERY_API_KEY', '')
+        if not query_api_key:
+            self.__logger('query api key not provided and env NEW_RELIC_QUERY_API_KEY not set')
+        self.__headers = {
+            'Accept': 'application/json',
+            'X-Query-Key': query_api_key
+        }
+        self.__rate_limiter = get_rate_limiter(query_api_key, rate_limit)
+        self.__account_id = account_id
+        query_api_url = os.getenv('NEW_RELIC_QUERY_API_URL', QUERY_API_URL).rstrip('/')
+        self.__url = f'{query_api_url}/v1/accounts/{account_id}/query'
+
+    async def __aenter__(self):
+        """async with support"""
+        return self
+
+    async def __aexit__(self, *args):
+        """async with support"""
+        await self.close()
+
+    async def close(self):
+        """closes the session created by this client"""
+        if self.__own_session and self.__session:
+            await self.__session.close()
+            self.__session = None
+
+    async def query(self, nrql, params={}, max_retries=MAX_RETRIES, windows=1):
+        """request a JSON result from the Insights Query API
+
+            windows > 1 splits the SINCE/UNTIL range and fetches the sub-windows concurrently
+        """
+        parsed_nrql = parse_nrql(nrql, params, self.__logger)
+        if windows > 1:
+            split_nrqls = split_time_window(parsed_nrql, windows)
+            if len(split_nrqls) < 2:
+                self.__logger('warning: cannot split the time window of {}', parsed_nrql, stop=False)
+            else:
+                responses = await asyncio.gather(*[self.__query(n, max_retries) for n in split_nrqls])
+                if not all(responses):
+                    self.__logger('warning: a sub-window of {} failed, fetching the whole window', parsed_nrql, stop=False)
+                else:
+                    response = merge_responses(responses)
+                    if response is not None:
+                        return response
+                    self.__logger('warning: cannot merge the sub-window results of {}, fetching the whole window', parsed_nrql, stop=False)
+        return await self.__query(parsed_nrql, max_retries)
+
+    async def query_many(self, nrqls, params={}, max_retries=MAX_RETRIES):
+        """request the JSON results of several nrqls, merging single value selects into one request"""
+        parsed_nrqls = [parse_nrql(nrql, params, self.__logger) for nrql in nrqls]
+        groups = merge_nrqls(parsed_nrqls)
+        responses = [None] * len(nrqls)
+        merged_responses = await asyncio.gather(*[self.__query(nrql, max_retries) for nrql,_ in groups])
+        for (_,members),response in zip(groups, merged_responses):
+            for index,start,stop in members:
+                if start is None:
+                    responses[index] = response
+                else:
+                    responses[index] = split_response(response, start, stop) if response else None
+        failed = [i for i,response in enumerate(responses) if response is None]
+        if failed:
+            self.__logger('warning: merged query failed, running its queries one by one', stop=False)
+            retried = await asyncio.gather(*[self.__query(parsed_nrqls[i], max_retries) for i in failed])
+            for i,response in zip(failed, retried):
+                responses[i] = response
+        return responses
+
+    async def __query(self, parsed_nrql, max_retries=MAX_RETRIES):
+        """request a JSON result for an already parsed nrql"""
+        metrics = {}
+        start = time.perf_counter()
+        results = await self.__fetch(parsed_nrql, max_retries, metrics)
+        METRICS.record('query', time.perf_counter() - start, account_id=self.__account_id, **metrics)
+        return results
+
+    async def __fetch(self, parsed_nrql, max_retries, metrics):
+        """cache lookup and retry loop behind __query, metrics collects bytes, retries and status"""
+        loop = asyncio.get_running_loop()
+        # only absolute windows are cached, the same relative nrql means another window on every run
+        cache = self.__cache if self.__cache and has_absolute_window(parsed_nrql) else None
+        if cache:
+            results = await loop.run_in_executor(None, cache.get, self.__account_id, parsed_nrql)
+            if results is not None:
+                metrics['cached'] = True
+                return results
+        if not self.__session:
+            self.__session = new_async_session(CONCURRENCY)
+        # recent windows can still receive late events and are not cached yet
+        request_time = time.time()
+        count_retries = 0
+        while count_retries < max_retries:
+            count_retries += 1
+            metrics['retries'] = count_retries - 1
+            if self.__rate_limiter:
+                wait = self.__rate_limiter.try_acquire()
+                while wait:
+                    await asyncio.sleep(wait)
+                    wait = self.__rate_limiter.try_acquire()
+            retry_after = None
+            try:
+                async with self.__semaphore:
+                    async with self.__session.get(
+                        self.__url, headers=self.__headers, params={'nrql': parsed_nrql}) as response:
+                        status_code = metrics['status'] = response.status
+                        if status_code == 200:
+                            body = await response.read()
+                            metrics['bytes'] = len(body)
+                            results = await response.json(content_type=None)
+                            if cache and is_window_closed(results, request_time):
+                                await loop.run_in_executor(None, cache.put, self.__account_id, parsed_nrql, results)
+                            return results
+                        retry_after = response.headers.get('Retry-After', None)
+                self.__logger(
+                    'warning: got a {} response fetching {} ({}/{})',
+                    status_code, self.__url, count_retries, max_retries, stop=False)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                pass
+            if count_retries < max_retries:
+                await asyncio.sleep(backoff_delay(count_retries, retry_after))
+
+        self.__logger(
+            'warning: gave up fetching {} after {} attempts',
+            self.__url, max_retries, stop=False)
+        return []
+
+    async def events(self, nrql, include={}, params={}, windows=1):
+        """execute the nrql and convert to an events async generator"""
+        response = await self.query(nrql, params=params, windows=windows)
+        for event in METRICS.timed_iter(parse_response(response, include), 'parse'):
+            yield event
+
+    async def rows(self, nrql, include={}, params={}, windows=1):
+        """execute the nrql and convert to Rows (header + row tuples)"""
+        response = await self.query(nrql, params=params, windows=windows)
+        return Rows(METRICS.timed_iter(parse_response(response, include), 'parse'))
+
+    async def columns(self, nrql, include={}, params={}, windows=1):
+        """execute the nrql and convert to Columns (one list or array per attribute)"""
+        return Columns(await self.rows(nrql, include, params, windows))
+
+
+# run all test cases concurrently
+if __name__ == "__main__":
+    import json, sys, yaml
+
+    async def main(queries):
+        params = {'some_since': '1 day ago', 'some_compare': '2 days ago', 'some_limit': 1}
+        async with AsyncNewRelicQueryAPI() as api:
+            async def run(query):
+                include = {'eventType': query['name']}
+                return [event async for event in api.events(query['nrql'], include=include, params=params)]
+            for events in await asyncio.gather(*[run(query) for query in queries]):
+                for event in events:
+                    print(json.dumps(event, sort_keys=False, indent=4))
+
+    with open('queries-samples.yaml') as f:
+        queries = yaml.load(f, Loader=yaml.FullLoader)
+    asyncio.run(main([query for query in queries if len(sys.argv) == 1 or query['name'] in sys.argv]))
@@ -0,0 +1,101 @@
+#
+# author: Paulo Monteiro
+# version: 0.1
+#
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+CACHE_TTL = 86400
+CACHE_SIZE_MB = 1024
+CACHE_SIZE = CACHE_SIZE_MB * 1024 * 1024
+CACHE_SUFFIX = '.json.gz'
+
+
+class QueryCache():
+    """ content addressed on-disk cache of Query API responses
+
+        - one gzip compressed JSON file per (account id, parsed nrql)
+        - entries written more than ttl seconds ago are treated as misses
+        - least recently used entries are evicted once the folder exceeds max_size bytes,
+          0 means unlimited
+        - callers only use it for absolute windows and only put closed ones, see
+          has_absolute_window and is_window_closed
+    """
+
+    def __init__(self, cache_dir, ttl=CACHE_TTL, max_size=CACHE_SIZE):
+        """init"""
+        os.makedirs(cache_dir, exist_ok=True)
+        self.__cache_dir = cache_dir
+        self.__ttl = ttl
+        self.__max_size = max_size
+        self.__lock = threading.Lock()
+        self.__size = sum(entry.stat().st_size for entry in self.__entries())
+
+    def __entries(self):
+        """lists all cache entries"""
+        return [entry for entry in os.scandir(self.__cache_dir) if entry.name.endswith(CACHE_SUFFIX)]
+
+    def __get_path(self, account_id, nrql):
+        """returns the entry file name for an account id and parsed nrql"""
+        key = hashlib.sha256(f'{account_id}\n{nrql}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.__cache_dir, key + CACHE_SUFFIX)
+
+    def __evict(self):
+        """removes least recently used entries until the cache fits max_size"""
+        entries = sorted(self.__entries(), key=lambda entry: entry.stat().st_atime)
+        for entry in entries:
+            if self.__size <= self.__max_size:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.__size -= size
+            except OSError:
+                pass
+
+    def get(self, account_id, nrql):
+        """returns the cached response or None on a miss"""
+        path = self.__get_path(account_id, nrql)
+        try:
+            stat = os.stat(path)
+            if self.__ttl and time.time() - stat.st_mtime > self.__ttl:
+                return None
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                response = json.load(f)
+            # refresh the access time only, mtime keeps tracking the ttl
+            os.utime(path, (time.time(), stat.st_mtime))
+            return response
+        except (OSError, ValueError):
+            return None
+
+    def put(self, account_id, nrql, response):
+        """stores a response, writes are atomic so concurrent readers never see partial files"""
+        path = self.__get_path(account_id, nrql)
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.__cache_dir, suffix='.tmp')
+            os.close(fd)
+            with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+                json.dump(response, f)
+            size = os.path.getsize(temp_path)
+            with self.__lock:
+                try:
+                    self.__size -= os.path.getsize(path)
+                except OSError:
+                    pass
+                os.replace(temp_path, path)
+                self.__size += size
+                if self.__max_size and self.__size > self.__max_size:
+                    self.__evict()
+        except OSError:
+            if temp_path and os.path.exists(temp_path):
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
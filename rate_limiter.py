@@ -0,0 +1,120 @@
+#
+# author: Paulo Monteiro
+# version: 0.1
+#
+
+from email.utils import parsedate_to_datetime
+import random
+import threading
+import time
+
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 60
+THROTTLE_STATUS_CODES = [429, 503]
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def parse_retry_after(retry_after):
+    """converts a Retry-After header (seconds or HTTP date) to seconds"""
+    if not retry_after:
+        return None
+    try:
+        return max(0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(retry, retry_after=None, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """exponential backoff with full jitter, a server Retry-After always wins"""
+    seconds = parse_retry_after(retry_after)
+    if seconds is not None:
+        return min(seconds, cap)
+    return random.uniform(0, min(cap, base * 2 ** retry))
+
+
+class TokenBucket():
+    """ thread safe token bucket allowing rate requests per second and bursts of capacity """
+
+    def __init__(self, rate, capacity=None):
+        """init"""
+        self.__rate = float(rate)
+        self.__capacity = float(capacity if capacity else max(1, rate))
+        self.__tokens = self.__capacity
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def try_acquire(self):
+        """takes a token if available and returns 0, otherwise returns the seconds to wait for one"""
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.__capacity, self.__tokens + (now - self.__updated) * self.__rate)
+            self.__updated = now
+            if self.__tokens >= 1:
+                self.__tokens -= 1
+                return 0
+            return (1 - self.__tokens) / self.__rate
+
+    def acquire(self):
+        """blocks until a token is available and takes it"""
+        wait = self.try_acquire()
+        while wait:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+
+class AdaptiveConcurrency():
+    """ AIMD controller for the number of requests in flight
+
+        - slow start: the limit grows by 1 per success up to the last known good limit
+        - congestion avoidance: then it grows by 1 per limit successes
+        - a throttled response (429/503) halves the limit
+    """
+
+    def __init__(self, maximum, minimum=1):
+        """init"""
+        self.__maximum = max(minimum, maximum)
+        self.__minimum = minimum
+        self.__limit = float(minimum)
+        self.__threshold = float(self.__maximum)
+        self.__in_flight = 0
+        self.__condition = threading.Condition()
+
+    def get_limit(self):
+        """returns the current concurrency limit"""
+        return int(self.__limit)
+
+    def acquire(self):
+        """blocks until a request slot is available"""
+        with self.__condition:
+            while self.__in_flight >= int(self.__limit):
+                self.__condition.wait()
+            self.__in_flight += 1
+
+    def release(self, throttled=False):
+        """frees a request slot and adjusts the limit"""
+        with self.__condition:
+            self.__in_flight -= 1
+            if throttled:
+                self.__threshold = max(self.__minimum, self.__limit / 2)
+                self.__limit = self.__threshold
+            elif self.__limit < self.__threshold:
+                self.__limit = min(self.__maximum, self.__limit + 1)
+            else:
+                self.__limit = min(self.__maximum, self.__limit + 1 / self.__limit)
+            self.__condition.notify_all()
+
+
+def get_rate_limiter(key, rate):
+    """returns the token bucket shared by all clients using the same API key"""
+    if not rate:
+        return None
+    with _rate_limiters_lock:
+        if not key in _rate_limiters:
+            _rate_limiters[key] = TokenBucket(rate)
+        return _rate_limiters[key]
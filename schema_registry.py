@@ -0,0 +1,69 @@
+#
+# author: Paulo Monteiro
+# version: 0.1
+#
+
+from operator import itemgetter
+import threading
+
+
+class Schema():
+    """ union of all the headers seen for one output, new columns are always appended """
+
+    def __init__(self):
+        """init"""
+        self.columns = []
+        self.__positions = {}
+        self.__aligners = {}
+
+    def merge(self, header):
+        """adds the header columns not seen yet, single pass over an ordered set"""
+        for column in header:
+            if not column in self.__positions:
+                self.__positions[column] = len(self.columns)
+                self.columns.append(column)
+
+    def get_aligner(self, header):
+        """returns a function mapping a row in header order to the union columns order
+
+            the mapping is cached per header, missing columns are filled with None
+        """
+        header = tuple(header)
+        width = len(self.columns)
+        key = (header, width)
+        if not key in self.__aligners:
+            index = {k:i for i,k in enumerate(header)}
+            # the extra None appended to every row fills the missing columns
+            indexes = [index.get(column, len(header)) for column in self.columns]
+            if indexes == list(range(len(header))):
+                aligner = lambda row: row
+            elif len(indexes) == 1:
+                getter = itemgetter(indexes[0])
+                aligner = lambda row: (getter(tuple(row) + (None,)),)
+            else:
+                getter = itemgetter(*indexes)
+                aligner = lambda row: getter(tuple(row) + (None,))
+            self.__aligners[key] = aligner
+        return self.__aligners[key]
+
+
+class SchemaRegistry():
+    """ one Schema per output name shared by all accounts in a run
+
+        later accounts with extra attributes extend the schema instead of
+        getting misaligned columns, and every backend reuses the cached aligners
+    """
+
+    def __init__(self):
+        """init"""
+        self.__schemas = {}
+        self.__lock = threading.Lock()
+
+    def get_schema(self, name, header=()):
+        """merges header into the name schema and returns it"""
+        with self.__lock:
+            if not name in self.__schemas:
+                self.__schemas[name] = Schema()
+            schema = self.__schemas[name]
+            schema.merge(header)
+        return schema
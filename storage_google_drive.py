@@ -3,34 +3,59 @@
 # version: 0.1
 #
 
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import json
 import os
+import threading
 import time
+import zlib
 
 from oauth2client.service_account import ServiceAccountCredentials
 from googleapiclient import discovery
 
+from newrelic_query_api import Rows
+from schema_registry import SchemaRegistry
 from storage_google_drive_helpers import *
 
 
 def abort(message):
     """abort the command"""
     print(message)
-    exit()
+    exit(1)
 
 class StorageGoogleDrive():
+    """ Google Drive folder / spreadsheets / sheets storage
+
+        writes are buffered per spreadsheet and sent as one batchUpdate when the buffer
+        reaches SHEET_BATCH_BYTES (a batch ends between appended chunks, so it can exceed
+        it by one chunk), when more than SHEET_OPEN_BUFFERS spreadsheets are buffered and
+        on flush(); different spreadsheets are flushed concurrently and batches of the
+        same spreadsheet are kept in order
+
+        folders children and spreadsheets sheets are listed once per run and indexed,
+        the index is kept up to date as objects and sheets are created
+
+        compact mode writes value only cells and sets the number / date format once per
+        column in format_data, columns only written by a resumed previous run keep no format
+    """
 
     OBJECT_TYPES = {
         'folder': 'application/vnd.google-apps.folder',
         'spreadsheet': 'application/vnd.google-apps.spreadsheet'
     }
 
-    def __init__(self, account_file_id, output_folder_id, secret_file, timestamp=None, prefix='RUN', writers=[], readers=[]):
-        """init"""
+    def __init__(self, account_file_id, output_folder_id, secret_file, timestamp=None, prefix='RUN', writers=[], readers=[], run_folder=None, schemas=None, compact=False):
+        """init, run_folder reopens the output of a previous run"""
         self.__cache = {}
+        self.__compact = compact
+        self.__number_kinds = {} # (spreadsheet id, sheet id) -> {column index: NUMBER_FORMATS key}
+        self.__widths = {}
+        self.__schemas = schemas if schemas else SchemaRegistry()
         self.__account_file_id = account_file_id
         self.__output_folder_id = output_folder_id
         self.__run_folder = \
+            run_folder if run_folder else \
             time.strftime(
                 f'{prefix}_%Y-%m-%d_%H-%M',
                 time.localtime() if not timestamp else timestamp
@@ -38,6 +63,14 @@ class StorageGoogleDrive():
         self.__run_folder_id = None
         self.__readers = readers
         self.__writers = writers
+        self.__buffers = {}
+        self.__flushing = {}
+        self.__lock = threading.Lock()
+        self.__last_spreadsheet_id = None
+        self.__objects = {} # parent id -> {(mime type, name): object id}
+        self.__sheets = {} # spreadsheet id -> {sheet name: sheet id}
+        self.__local = threading.local()
+        self.__executor = ThreadPoolExecutor(max_workers=SHEET_FLUSH_WORKERS)
         try:
             credentials = ServiceAccountCredentials.from_json_keyfile_name(
                 secret_file,
@@ -51,9 +84,93 @@ class StorageGoogleDrive():
             self.__files = drive.files() # pylint: disable=no-member
             self.__permissions = drive.permissions() # pylint: disable=no-member
             self.__spreadsheets = sheets.spreadsheets() # pylint: disable=no-member
+            self.__credentials = credentials
         except:
             abort('error: cannot open a connection to Google API')
 
+    def __get_spreadsheets(self):
+        """returns a spreadsheets resource for the current thread, the API client is not thread safe"""
+        if threading.current_thread() is threading.main_thread():
+            return self.__spreadsheets
+        if not hasattr(self.__local, 'spreadsheets'):
+            sheets = discovery.build('sheets', 'v4', credentials=self.__credentials)
+            self.__local.spreadsheets = sheets.spreadsheets() # pylint: disable=no-member
+        return self.__local.spreadsheets
+
+    def __queue(self, spreadsheet_id, requests):
+        """buffers batchUpdate requests for a spreadsheet"""
+        size = sum(len(json.dumps(request)) for request in requests)
+        buffer = self.__buffers.get(spreadsheet_id, None)
+        if not buffer:
+            # dicts keep insertion order, the first key is the least recently opened buffer
+            if len(self.__buffers) >= SHEET_OPEN_BUFFERS:
+                self.__flush(next(iter(self.__buffers)))
+            buffer = self.__buffers[spreadsheet_id] = {'requests': [], 'bytes': 0, 'callbacks': []}
+        buffer['requests'].extend(requests)
+        buffer['bytes'] += size
+        self.__last_spreadsheet_id = spreadsheet_id
+
+    def __flush_full(self, spreadsheet_id):
+        """flushes the spreadsheet buffer once it reaches SHEET_BATCH_BYTES
+
+            only called between appended chunks, so a new sheet and its header row
+            always go out in the same batch
+        """
+        buffer = self.__buffers.get(spreadsheet_id, None)
+        if buffer and buffer['bytes'] >= SHEET_BATCH_BYTES:
+            self.__flush(spreadsheet_id)
+
+    def __execute(self, spreadsheet_id, requests, previous, written):
+        """runs on a flush thread: waits the previous batch of the spreadsheet, sends this one and runs its callbacks"""
+        if previous:
+            previous['future'].result()
+        body = {'requests': requests}
+        response = self.__get_spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute()
+        with self.__lock:
+            written['done'] = True
+            for callback in written['callbacks']:
+                callback()
+        return response
+
+    def __flush(self, spreadsheet_id):
+        """sends the buffered requests of a spreadsheet in the background"""
+        buffer = self.__buffers.pop(spreadsheet_id, None)
+        if not buffer:
+            return
+        previous = self.__flushing.get(spreadsheet_id, None)
+        written = {'done': False, 'callbacks': buffer['callbacks']}
+        written['future'] = self.__executor.submit(self.__execute, spreadsheet_id, buffer['requests'], previous, written)
+        self.__flushing[spreadsheet_id] = written
+        # surface the errors of the batches already sent
+        for written in self.__flushing.values():
+            if written['future'].done():
+                written['future'].result()
+
+    def flush(self):
+        """sends all buffered requests and waits until they are written"""
+        for spreadsheet_id in list(self.__buffers):
+            self.__flush(spreadsheet_id)
+        for written in self.__flushing.values():
+            written['future'].result()
+        self.__flushing = {}
+
+    def when_written(self, callback):
+        """calls callback once everything dumped so far is written to Google Sheets
+
+            only the last spreadsheet written can have pending rows of the last dump,
+            the callback runs on the flush thread right after its batchUpdate succeeds
+        """
+        buffer = self.__buffers.get(self.__last_spreadsheet_id, None)
+        if buffer:
+            buffer['callbacks'].append(callback)
+            return
+        with self.__lock:
+            written = self.__flushing.get(self.__last_spreadsheet_id, None)
+            if written and not written['done']:
+                written['callbacks'].append(callback)
+            else:
+                callback()
+
     def __set_permissions(self, object_id):
         """set readers / writers permission on object id"""
         if object_id:
@@ -72,14 +189,29 @@ class StorageGoogleDrive():
         except:
             abort('error: unsuported Google Drive object type')
 
+    def __get_objects(self, parent_id):
+        """return the {(mime type, name): id} index of a parent id, listed once per run"""
+        objects = self.__objects.get(parent_id, None)
+        if objects is None:
+            objects = self.__objects[parent_id] = {}
+            query = f"'{parent_id}' in parents and trashed = false"
+            page_token = None
+            while True:
+                response = self.__files.list(
+                    q=query, spaces='drive', fields='nextPageToken, files(id, name, mimeType)',
+                    orderBy='createdTime', pageToken=page_token).execute()
+                for item in response.get('files', []):
+                    # with duplicated names the oldest object wins
+                    objects.setdefault((item.get('mimeType', ''), item.get('name', '')), item.get('id', None))
+                page_token = response.get('nextPageToken', None)
+                if not page_token:
+                    break
+        return objects
+
     def __get_object_id(self, object_type, object_name, parent_id):
         """search for an object name / type under a parent id and return the id"""
         mime_type = self.__get_mime_type(object_type)
-        query = f"'{parent_id}' in parents and name = '{object_name}' and mimeType = '{mime_type}'"
-        response = self.__files.list(q=query, spaces='drive', fields='files(id)').execute()
-        files = response.get('files', [])
-        object_id = files[0].get('id', None) if len(files) == 1 else None
-        return object_id
+        return self.__get_objects(parent_id).get((mime_type, object_name), None)
 
     def __create_object(self, object_type, object_name, parent_id):
         """create a new object"""
@@ -89,27 +221,47 @@ class StorageGoogleDrive():
             body = {'name': object_name, 'mimeType': mime_type, 'parents': [parent_id]}
             response = self.__files.create(body=body).execute()
             object_id = response.get('id', None)
+            self.__objects[parent_id][(mime_type, object_name)] = object_id
+            # a new object has no children and a new spreadsheet has only Sheet1
+            if object_type == 'folder':
+                self.__objects[object_id] = {}
+            elif object_type == 'spreadsheet':
+                self.__sheets[object_id] = {'Sheet1': SHEET1_SHEET_ID}
             just_created = True
         else:
             just_created = False
         return object_id, just_created
 
+    def __get_sheets(self, spreadsheet_id):
+        """return the {name: id} index of the sheets in a spreadsheet id, fetched once per run"""
+        sheets = self.__sheets.get(spreadsheet_id, None)
+        if sheets is None:
+            response = self.__spreadsheets.get(spreadsheetId=spreadsheet_id, fields='sheets.properties').execute()
+            sheets = self.__sheets[spreadsheet_id] = {}
+            for sheet in response.get('sheets', []):
+                properties = sheet.get('properties', {})
+                sheets[properties.get('title', '')] = properties.get('sheetId', None)
+        return sheets
+
     def __get_sheet_id(self, spreadsheet_id, sheet_name):
         """search for a sheet name in a spreadsheet id and return the id"""
-        response = self.__spreadsheets.get(spreadsheetId=spreadsheet_id).execute()
-        sheets = response.get('sheets', [])
-        sheets = [k for i,k in enumerate(sheets) if k.get('name', None) == sheet_name]
-        sheet_id = sheets[0].get('properties', {}).get('sheetId', None) if len(sheets) == 1 else None
+        return self.__get_sheets(spreadsheet_id).get(sheet_name, None)
+
+    def __new_sheet_id(self, spreadsheet_id, sheet_name):
+        """assigns a sheet id up front so addSheet does not need a round trip for its reply"""
+        used = set(self.__get_sheets(spreadsheet_id).values())
+        sheet_id = zlib.crc32(sheet_name.encode('utf-8')) & 0x7fffffff
+        while sheet_id in used:
+            sheet_id = (sheet_id + 1) & 0x7fffffff
         return sheet_id
 
     def __create_sheet(self, spreadsheet_id, sheet_name):
-        """create a new sheet"""
+        """create a new sheet, the addSheet request is buffered"""
         sheet_id = self.__get_sheet_id(spreadsheet_id, sheet_name)
-        if not sheet_id:
-            body = {'requests': [add_sheet_request(sheet_name)]}
-            response = self.__spreadsheets.batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute()
-            sheet_id = \
-                response.get('replies', [{}])[0].get('addSheet', {}).get('properties', {}).get('sheetId', None)
+        if sheet_id is None:
+            sheet_id = self.__new_sheet_id(spreadsheet_id, sheet_name)
+            self.__sheets[spreadsheet_id][sheet_name] = sheet_id
+            self.__queue(spreadsheet_id, [add_sheet_request(sheet_name, sheet_id)])
             self.__fit_sheet_rows(spreadsheet_id, sheet_id)
             just_created = True
         else:
@@ -129,14 +281,21 @@ class StorageGoogleDrive():
         else:
             requests = None
         if requests:
-            body = {'requests': requests}
-            self.__spreadsheets.batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute()
+            self.__queue(spreadsheet_id, requests)
 
     def __fit_sheet_rows(self, spreadsheet_id, sheet_id):
         """set the total number of rows to 1 by removing rows 2..1000"""
         requests = [delete_dimension_request(sheet_id, "ROWS", 1, SHEET_DEFAULT_ROWS)]
-        body = {'requests': requests}
-        self.__spreadsheets.batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute()
+        self.__queue(spreadsheet_id, requests)
+
+    def __extend_header(self, spreadsheet_id, sheet_id, columns, width):
+        """append the columns added by later accounts to the sheet header"""
+        cells = [{'values': [cell_snippet(column) for column in columns[width:]]}]
+        requests = [
+            append_dimension_request(sheet_id, 'COLUMNS', len(columns) - width),
+            update_cells_request(sheet_id, cells, 0, width)
+        ]
+        self.__queue(spreadsheet_id, requests)
 
     def __get_dataset(self, spreadsheet_id, _range):
         """return a list of accounts dictionaries"""
@@ -145,15 +304,44 @@ class StorageGoogleDrive():
 
     def __append_dataset(self, spreadsheet_id, sheet_id, values=[], dates_idx=[]):
         """append new rows to a sheet from a list (rows) of a list (columns) of values"""
+        if self.__compact:
+            self.__append_values(spreadsheet_id, sheet_id, values, dates_idx)
+            return
         rows = [{"values": [cell_snippet(cell, idx in dates_idx) for idx,cell in enumerate(row)]} for row in values]
         if rows:
-            body = {'requests': [append_cells_request(sheet_id, rows)]}
-            self.__spreadsheets.batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute()
+            self.__queue(spreadsheet_id, [append_cells_request(sheet_id, rows)])
+
+    def __append_values(self, spreadsheet_id, sheet_id, values=[], dates_idx=[]):
+        """compact mode append, tracks the number kind of each column for format_data"""
+        kinds = self.__number_kinds.setdefault((spreadsheet_id, sheet_id), {})
+        rows = []
+        for row in values:
+            for idx,cell in enumerate(row):
+                kind = get_number_kind(cell, idx in dates_idx)
+                # a column with int and float values gets the float format
+                if kind and kinds.get(idx, 'int') == 'int':
+                    kinds[idx] = kind
+            rows.append({"values": [value_snippet(cell) for cell in row]})
+        if rows:
+            self.__queue(spreadsheet_id, [append_cells_request(sheet_id, rows, 'userEnteredValue')])
+
+    def __load_run_folder(self):
+        """cache the spreadsheets / sheets already written to the run folder by a previous run"""
+        mime_type = self.__get_mime_type('spreadsheet')
+        for (object_mime_type,spreadsheet_name),spreadsheet_id in self.__get_objects(self.__run_folder_id).items():
+            if object_mime_type != mime_type:
+                continue
+            self.__cache.update({spreadsheet_name: spreadsheet_id})
+            for sheet_name,sheet_id in self.__get_sheets(spreadsheet_id).items():
+                # Sheet1 and pivot tables are handled by format_data
+                if sheet_id == SHEET1_SHEET_ID or sheet_name.startswith('PV_'):
+                    continue
+                self.__cache.update({(spreadsheet_name,sheet_name): (spreadsheet_id,sheet_id)})
 
     def __get_handle(self, spreadsheet_name, sheet_name):
         """return a (spreadsheet,sheet) handle and a flag if just created"""
         if not spreadsheet_name in self.__cache:
-            spreadsheet_id, just_created = self.__create_object('spreadsheet', spreadsheet_name, self.__run_folder_id)
+            spreadsheet_id, _ = self.__create_object('spreadsheet', spreadsheet_name, self.__run_folder_id)
             self.__cache.update({spreadsheet_name: spreadsheet_id})
         else:
             spreadsheet_id = self.__cache[spreadsheet_name]
@@ -164,6 +352,10 @@ class StorageGoogleDrive():
             just_created = False
         return self.__cache[(spreadsheet_name,sheet_name)], just_created
 
+    def get_run_folder(self):
+        """returns the run folder name under the output folder"""
+        return self.__run_folder
+
     def get_accounts(self, sheet_range='Sheet1'):
         """return a list of accounts dictionaries"""
         values = self.__get_dataset(self.__account_file_id, sheet_range)
@@ -174,57 +366,80 @@ class StorageGoogleDrive():
                 accounts.append({headers[k]:v for k,v in enumerate(row)})
         return accounts
 
-    def dump_data(self, spreadsheet_name, sheet_name, data=[]):
-        """appends the data to the output spreadsheet/sheet"""
+    def dump_data(self, spreadsheet_name, sheet_name, data=[], chunk_size=SHEET_APPEND_ROWS):
+        """appends the data to the output spreadsheet/sheet in chunks of chunk_size rows"""
         if not self.__run_folder_id:
-            self.__run_folder_id, _ = self.__create_object(
+            self.__run_folder_id, just_created = self.__create_object(
                 'folder',
                 self.__run_folder,
                 self.__output_folder_id
             )
-        if type(data) == list and len(data):
+            if not just_created:
+                self.__load_run_folder()
+        rows = Rows.from_data(data)
+        headers = list(rows.header)
+        rows = iter(rows)
+        chunk = list(islice(rows, chunk_size))
+        if chunk:
             (spreadsheet_id, sheet_id), just_created = \
                 self.__get_handle(spreadsheet_name, sheet_name)
-            headers = list(data[0].keys())
-            dates_idx = [k for k,v in enumerate(headers) if 'datetime' in v]
+            # all sheets of a query share the same union schema and columns order
+            if not just_created and not (spreadsheet_id, sheet_id) in self.__widths:
+                header = self.__get_dataset(spreadsheet_id, f"'{sheet_name}'!1:1")
+                header = header[0] if header else []
+                self.__schemas.get_schema(sheet_name, header)
+                self.__widths[(spreadsheet_id, sheet_id)] = len(header)
+            schema = self.__schemas.get_schema(sheet_name, headers)
+            columns = list(schema.columns)
+            dates_idx = [k for k,v in enumerate(columns) if 'datetime' in v]
             if just_created:
-                sheet_data = [headers]
-                self.__fit_sheet_columns(spreadsheet_id, sheet_id, len(headers))
+                sheet_data = [columns]
+                self.__fit_sheet_columns(spreadsheet_id, sheet_id, len(columns))
+                self.__widths[(spreadsheet_id, sheet_id)] = len(columns)
             else:
                 sheet_data = []
-            sheet_data.extend([list(row.values()) for row in data])
-            self.__append_dataset(spreadsheet_id, sheet_id, sheet_data, dates_idx)
+                width = self.__widths[(spreadsheet_id, sheet_id)]
+                if width < len(columns):
+                    self.__extend_header(spreadsheet_id, sheet_id, columns, width)
+                    self.__widths[(spreadsheet_id, sheet_id)] = len(columns)
+            align = schema.get_aligner(headers)
+            while chunk:
+                sheet_data.extend(align(row) for row in chunk)
+                self.__append_dataset(spreadsheet_id, sheet_id, sheet_data, dates_idx)
+                self.__flush_full(spreadsheet_id)
+                sheet_data = []
+                chunk = list(islice(rows, chunk_size))
 
     def format_data(self, pivots={}):
         """ format all spreadsheets / sheets in the cache """
-        requests_queue = {}
-        for k,v in iter(self.__cache.items()):
+        self.flush()
+        for k,v in list(self.__cache.items()):
             if type(k) == tuple:
                 (_,sheet_name), (spreadsheet_id,sheet_id) = k, v
-                if not spreadsheet_id in requests_queue:
-                    requests_queue[spreadsheet_id] = []
                 # add all formatting requests to the queue
-                requests_queue[spreadsheet_id].extend([
+                self.__queue(spreadsheet_id, [
                     basic_filter_request(sheet_id),
                     format_header_request(sheet_id),
                     freeze_rows_request(sheet_id),
                     freeze_columns_request(sheet_id, 3),
                     auto_resize_dimension_request(sheet_id)
                 ])
+                kinds = self.__number_kinds.get((spreadsheet_id, sheet_id), {})
+                if kinds:
+                    self.__queue(spreadsheet_id,
+                        [number_format_request(sheet_id, idx, kind) for idx,kind in sorted(kinds.items())])
                 # create and add a pivot table to the queue
                 if sheet_name in pivots:
                     pv_sheet_name = 'PV_' + sheet_name
                     pv_sheet_id, _ = self.__create_sheet(spreadsheet_id, pv_sheet_name)
                     headers = self.__get_dataset(spreadsheet_id, sheet_name + '!1:1')[0]
                     pv_table = pivot_table_snippet(sheet_id, pivots[sheet_name], headers)
-                    requests_queue[spreadsheet_id].append(pivot_request(pv_sheet_id, pv_table))
-            # remove sheet1
+                    self.__queue(spreadsheet_id, [pivot_request(pv_sheet_id, pv_table)])
+            # remove sheet1, unless a previous run already did
             else:
-                spreadsheet_id = v
-                if not v in requests_queue:
-                    requests_queue[spreadsheet_id] = []
-                requests_queue[spreadsheet_id].append(delete_sheet_request(SHEET1_SHEET_ID))
+                sheets = self.__get_sheets(v)
+                if SHEET1_SHEET_ID in sheets.values():
+                    self.__queue(v, [delete_sheet_request(SHEET1_SHEET_ID)])
+                    self.__sheets[v] = {name:sheet_id for name,sheet_id in sheets.items() if sheet_id != SHEET1_SHEET_ID}
         # post the batch request queue
-        for spreadsheet_id,requests in iter(requests_queue.items()):
-            body = {'requests': requests}
-            self.__spreadsheets.batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute()
\ No newline at end of file
+        self.flush()
@@ -6,35 +6,49 @@
 SHEET1_SHEET_ID=0
 SHEET_DEFAULT_COLUMNS=26
 SHEET_DEFAULT_ROWS=1000
+SHEET_APPEND_ROWS=1000
+SHEET_BATCH_BYTES=2*1024*1024
+SHEET_OPEN_BUFFERS=8
+SHEET_FLUSH_WORKERS=4
+NUMBER_FORMATS={
+    'int': {'type': 'NUMBER', 'pattern': '#,##0'},
+    'float': {'type': 'NUMBER', 'pattern': '#,##0.00'},
+    'date': {'type': 'DATE', 'pattern': 'yyyy/mm/dd hh:mm:ss'}
+}
+
+def get_number_kind(x, is_date=False):
+    """return the NUMBER_FORMATS key of a value or None if not a number"""
+    if type(x) == int:
+        return 'int'
+    elif type(x) == float:
+        return 'date' if is_date else 'float'
+    return None
+
 
 def cell_snippet(x, is_date=False):
     """create the proper cell snippet depending on the value type"""
-    if type(x) == int:
+    kind = get_number_kind(x, is_date)
+    if kind:
         return {
             'userEnteredValue': {'numberValue': x},
             'userEnteredFormat': {
-                'numberFormat': {
-                    'type': 'NUMBER',
-                    'pattern': '#,##0'
-                }
+                'numberFormat': NUMBER_FORMATS[kind]
             }
         }
-    elif type(x) == float:
-       return {
-           'userEnteredValue': {'numberValue': x},
-           'userEnteredFormat': {
-               'numberFormat': {
-                    'type': 'DATE' if is_date else 'NUMBER',
-                    'pattern': 'yyyy/mm/dd hh:mm:ss' if is_date else '#,##0.00'
-               }
-           }
-       }
     else:
         return {
             'userEnteredValue': {'stringValue': x}
         }
 
 
+def value_snippet(x):
+    """create a value only cell snippet, the number format is set per column"""
+    if type(x) in [int, float]:
+        return {'userEnteredValue': {'numberValue': x}}
+    else:
+        return {'userEnteredValue': {'stringValue': x}}
+
+
 def pivot_table_snippet(sheet_id, pivot, headers):
     """create a pivotTable snippet from a pivot dict and headers list"""
     try:
@@ -69,12 +83,13 @@ def pivot_table_snippet(sheet_id, pivot, headers):
     }
 
 
-def add_sheet_request(title):
+def add_sheet_request(title, sheet_id=None):
+    properties = {'title': title}
+    if sheet_id is not None:
+        properties['sheetId'] = sheet_id
     return {
         'addSheet': {
-            'properties': {
-                'title': title
-            }
+            'properties': properties
         }
     }
 
@@ -110,12 +125,26 @@ def delete_dimension_request(sheet_id, dimension, start_index=0, end_index=1):
     }
 
 
-def append_cells_request(sheet_id, rows):
+def append_cells_request(sheet_id, rows, fields='*'):
     return {
         'appendCells': {
             'sheetId': sheet_id,
             'rows': rows,
-            'fields': '*',
+            'fields': fields,
+        }
+    }
+
+
+def update_cells_request(sheet_id, rows, row_index=0, column_index=0):
+    return {
+        'updateCells': {
+            'rows': rows,
+            'start': {
+                'sheetId': sheet_id,
+                'rowIndex': row_index,
+                'columnIndex': column_index
+            },
+            'fields': '*'
         }
     }
 
@@ -173,6 +202,25 @@ def format_header_request(sheet_id):
     }
 
 
+def number_format_request(sheet_id, column_index, kind):
+    return {
+        'repeatCell': {
+            'range': {
+                'sheetId': sheet_id,
+                'startRowIndex': 1,
+                'startColumnIndex': column_index,
+                'endColumnIndex': column_index + 1
+            },
+            'cell': {
+                'userEnteredFormat': {
+                    'numberFormat': NUMBER_FORMATS[kind]
+                }
+            },
+            'fields': 'userEnteredFormat.numberFormat'
+        }
+    }
+
+
 def freeze_rows_request(sheet_id, frozen_row_count=1):
     return {
         'updateSheetProperties': {
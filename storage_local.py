@@ -5,15 +5,64 @@
 
 import csv
 import os
+import re
 import time
 
+from newrelic_query_api import Rows
+from schema_registry import Schema, SchemaRegistry
+
+SHARD_FILE_PATTERN = re.compile(r'^(.+)\.shard(\d+)\.csv$')
+
+
+def merge_shards(folder):
+    """merges the name.shardN.csv files written by the shards of a run into name.csv, returns the names"""
+    shards = {}
+    for filename in os.listdir(folder):
+        match = SHARD_FILE_PATTERN.match(filename)
+        if match:
+            shards.setdefault(match.group(1), []).append((int(match.group(2)), filename))
+    for name,files in sorted(shards.items()):
+        target = os.path.join(folder, name + '.csv')
+        paths = [os.path.join(folder, filename) for _,filename in sorted(files)]
+        # a previous merge is kept and extended
+        if os.path.exists(target):
+            paths.insert(0, target)
+        schema, headers = Schema(), []
+        for path in paths:
+            with open(path) as f:
+                headers.append(next(csv.reader(f), []))
+            schema.merge(headers[-1])
+        with open(target + '.tmp', 'w') as f_out:
+            csv_writer = csv.writer(f_out)
+            csv_writer.writerow(schema.columns)
+            for path,header in zip(paths, headers):
+                align = schema.get_aligner(header)
+                with open(path) as f_in:
+                    csv_reader = csv.reader(f_in)
+                    next(csv_reader, None)
+                    csv_writer.writerows(align(row) for row in csv_reader)
+        os.replace(target + '.tmp', target)
+        for path in paths[1:] if paths[0] == target else paths:
+            os.remove(path)
+    return sorted(shards)
+
+
 class StorageLocal():
 
-    def __init__(self, account_file, output_folder, timestamp=None, prefix='RUN'):
-        """init"""
+    def __init__(self, account_file, output_folder, timestamp=None, prefix='RUN', run_folder=None, schemas=None, suffix='', is_completed=None):
+        """init, run_folder reopens the output of a previous run, suffix tells the files of a shard apart
+
+            is_completed(master_name, account_id, query_name) tells the queries journaled by the
+            resumed run, rows of any other query (e.g. cut by a crash) are dropped when a file is reopened
+        """
         self.__cache = {}
+        self.__is_completed = is_completed
+        self.__suffix = suffix
+        self.__widths = {}
+        self.__schemas = schemas if schemas else SchemaRegistry()
         self.__account_file = account_file
         self.__output_folder = \
+            run_folder if run_folder else \
             os.path.join(
                 output_folder,
                 time.strftime(
@@ -22,16 +71,61 @@ class StorageLocal():
                 )
             )
 
+    def __get_path(self, name):
+        """returns the csv file path"""
+        return os.path.join(self.__output_folder, name + self.__suffix + '.csv')
+
+    def __drop_incomplete(self, name, master, output_file):
+        """drops the rows of the queries the resumed run did not complete, returns the file header"""
+        path = self.__get_path(name)
+        with open(path) as f_in:
+            csv_reader = csv.reader(f_in)
+            header = next(csv_reader, None)
+            if not header or not self.__is_completed or not 'account_id' in header:
+                return header
+            account_idx = header.index('account_id')
+            rows = list(csv_reader)
+        kept = [row for row in rows if len(row) > account_idx and self.__is_completed(master, row[account_idx], output_file)]
+        if len(kept) < len(rows):
+            with open(path + '.tmp', 'w') as f_out:
+                csv_writer = csv.writer(f_out)
+                csv_writer.writerow(header)
+                csv_writer.writerows(kept)
+            os.replace(path + '.tmp', path)
+        return header
+
     #@contextmanager
-    def __get_handle(self, name):
-        """returns a file handle from the cache or creates a new one"""
+    def __get_handle(self, name, master, output_file):
+        """returns a file handle from the cache or creates a new one, plus the header already in the file"""
+        header = None
         if not name in self.__cache:
-            handler = open(os.path.join(self.__output_folder, name + '.csv'), 'w')
+            # append so a resumed run keeps what was written before the crash
+            try:
+                header = self.__drop_incomplete(name, master, output_file)
+            except FileNotFoundError:
+                pass
+            handler = open(self.__get_path(name), 'a')
             self.__cache.update({name: handler})
-            just_created = True
-        else:
-            just_created = False
-        return self.__cache[name], just_created
+        return self.__cache[name], header
+
+    def __rewrite_header(self, name, columns):
+        """rewrites the file with the final columns when later accounts added new ones"""
+        path = self.__get_path(name)
+        with open(path) as f_in, open(path + '.tmp', 'w') as f_out:
+            csv_reader, csv_writer = csv.reader(f_in), csv.writer(f_out)
+            next(csv_reader, None)
+            csv_writer.writerow(columns)
+            for row in csv_reader:
+                csv_writer.writerow(row + [''] * (len(columns) - len(row)))
+        os.replace(path + '.tmp', path)
+
+    def when_written(self, callback):
+        """calls callback once everything dumped so far is written, writes are synchronous"""
+        callback()
+
+    def get_run_folder(self):
+        """returns the run output folder"""
+        return self.__output_folder
 
     def get_accounts(self):
         """returns a list of accounts dictionaries"""
@@ -43,20 +137,36 @@ class StorageLocal():
             return []
 
     def dump_data(self, master, output_file, data=[]):
-        """appends the data to the output file"""
+        """appends the data to the output file
+
+            rows are parsed while they are written, parse and write errors are raised so
+            the query is neither journaled nor marked
+        """
         if not self.__cache:
-            os.mkdir(self.__output_folder, mode=0o755)
-        try:
-            handle, just_created = self.__get_handle(master + '_' + output_file)
-            csv_writer = csv.DictWriter(handle, fieldnames=data[0].keys())
-            if just_created:
-                csv_writer.writeheader()
-            for row in data:
-                csv_writer.writerow(row)
-            handle.flush()
-        except:
-            pass
+            os.makedirs(self.__output_folder, mode=0o755, exist_ok=True)
+        # data can be Rows, Columns or any iterable of dicts, rows are written as they are produced
+        rows = Rows.from_data(data)
+        if not rows.header:
+            return
+        name = master + '_' + output_file
+        handle, header = self.__get_handle(name, master, output_file)
+        # all files of a query share the same union schema and columns order
+        if header:
+            self.__schemas.get_schema(output_file, header)
+            self.__widths[name] = (output_file, len(header))
+        schema = self.__schemas.get_schema(output_file, rows.header)
+        csv_writer = csv.writer(handle)
+        if not name in self.__widths:
+            csv_writer.writerow(schema.columns)
+            self.__widths[name] = (output_file, len(schema.columns))
+        align = schema.get_aligner(rows.header)
+        csv_writer.writerows(align(row) for row in rows)
+        handle.flush()
 
     def destroy(self):
         for filename in self.__cache:
-            self.__cache[filename].close()
\ No newline at end of file
+            self.__cache[filename].close()
+        for name,(output_file,width) in self.__widths.items():
+            columns = self.__schemas.get_schema(output_file).columns
+            if width < len(columns):
+                self.__rewrite_header(name, columns)
\ No newline at end of file
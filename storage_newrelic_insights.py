@@ -3,36 +3,188 @@
 # version: 0.1
 #
 
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import csv
+import glob
+import gzip
 import json
+import os
+import threading
+import time
+import uuid
 import requests
 
+from instrumentation import METRICS
+from newrelic_query_api import msg, new_session, Rows
+from rate_limiter import backoff_delay, THROTTLE_STATUS_CODES
+
 
 class StorageNewRelicInsights():
+    """ New Relic Insights events storage
+
+        - events are sent in gzip payloads of up to INSIGHTS_MAX_EVENTS events and
+          INSIGHTS_MAX_BYTES uncompressed bytes
+        - payloads are posted by INSERT_WORKERS background threads, dump_data only blocks
+          when MAX_PENDING payloads are waiting, destroy() waits for all of them
+        - throttled and failed posts are retried with backoff, honoring Retry-After
+        - payloads still failing are kept in spool_dir (a .json.gz payload and a .meta.json
+          file each) until replay() sends them
+    """
 
     INSIGHTS_MAX_EVENTS = 1000
+    INSIGHTS_MAX_BYTES = 1000000
+    INSERT_API_URL = 'https://insights-collector.newrelic.com'
     MAX_RETRIES = 5
+    INSERT_WORKERS = 4
+    MAX_PENDING = 16
+    COMPRESS_LEVEL = 6
+    SPOOL_DIR = 'insights-spool'
 
-    def __init__(self, account_file, insert_account_id, insert_api_key, timestamp=None):
+    def __init__(self, account_file, insert_account_id, insert_api_key, timestamp=None, session=None, workers=INSERT_WORKERS, spool_dir=SPOOL_DIR):
         """init"""
+        self.__session = session if session else new_session()
         self.__account_file = account_file
         self.__headers = {
             'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip',
             'X-Insert-Key': insert_api_key
         }
-        self.__url = f'https://insights-collector.newrelic.com/v1/accounts/{insert_account_id}/events'
+        # env NEW_RELIC_INSERT_API_URL points the storage to another endpoint (e.g. a mock server)
+        insert_api_url = os.getenv('NEW_RELIC_INSERT_API_URL', StorageNewRelicInsights.INSERT_API_URL).rstrip('/')
+        self.__url = f'{insert_api_url}/v1/accounts/{insert_account_id}/events'
+        self.__insert_account_id = insert_account_id
         self.__timestamp = timestamp
+        self.__spool_dir = spool_dir
+        self.__executor = ThreadPoolExecutor(max_workers=workers)
+        self.__pending = []
+        self.__lock = threading.Lock()
 
-    def __gen_chunk(self, event_type, data=[], chunk_size=INSIGHTS_MAX_EVENTS):
-        """slices data at chunk_size and generates a chunk with event_type injected in all dicts"""
+    def __gen_chunk(self, event_type, data=[], chunk_size=INSIGHTS_MAX_EVENTS, chunk_bytes=INSIGHTS_MAX_BYTES):
+        """generates lists of JSON encoded events with event_type injected, sliced at chunk_size events or chunk_bytes"""
         try:
             metadata = {'eventType': event_type, 'timestamp': self.__timestamp}
-            for i in range(0, len(data), chunk_size):
+            rows = Rows.from_data(data)
+            header = rows.header
+            chunk, size = [], 2
+            for row in rows:
                 # metadata attributes have lower priority over event attributes
-                yield [{**metadata, **event} for event in data[i:i+chunk_size]]
+                event = json.dumps({**metadata, **dict(zip(header, row))})
+                if chunk and (len(chunk) >= chunk_size or size + len(event) + 1 > chunk_bytes):
+                    yield chunk
+                    chunk, size = [], 2
+                chunk.append(event)
+                size += len(event) + 1
+            if chunk:
+                yield chunk
         except:
             pass
 
+    def __send(self, payload, events, max_retries):
+        """posts a compressed payload, retrying with backoff, returns the last status code and attempts"""
+        start = time.perf_counter()
+        status_code = None
+        count_retries = 0
+        while count_retries < max_retries:
+            count_retries += 1
+            retry_after = None
+            try:
+                response = self.__session.post(self.__url, data=payload, headers=self.__headers)
+                status_code = response.status_code
+                if status_code == requests.codes.ok:
+                    break
+                retry_after = response.headers.get('Retry-After', None)
+                # other client errors will not succeed on retry
+                if 400 <= status_code < 500 and not status_code in THROTTLE_STATUS_CODES:
+                    break
+            except requests.exceptions.RequestException:
+                status_code = None
+            if count_retries < max_retries:
+                time.sleep(backoff_delay(count_retries, retry_after))
+        METRICS.record('insert', time.perf_counter() - start,
+            rows=events, bytes=len(payload), retries=count_retries - 1, status=status_code)
+        return status_code, count_retries
+
+    def __post(self, chunk, event_type, max_retries):
+        """compresses and posts a chunk, spooling it if it is not accepted"""
+        payload = gzip.compress(('[' + ','.join(chunk) + ']').encode('utf-8'), self.COMPRESS_LEVEL)
+        status_code, attempts = self.__send(payload, len(chunk), max_retries)
+        if status_code != requests.codes.ok:
+            spool_file = self.__spool(payload, event_type, len(chunk), status_code, attempts)
+            msg('warning: gave up inserting {} events to {} after {} attempts (status {}), {}',
+                len(chunk), self.__url, attempts, status_code,
+                f'spooled to {spool_file}' if spool_file else 'events lost', stop=False)
+
+    def __spool(self, payload, event_type, events, status_code, attempts):
+        """writes a failed payload and its metadata to the spool folder, returns the payload file"""
+        if not self.__spool_dir:
+            return None
+        name = os.path.join(self.__spool_dir, f'{time.strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex}')
+        metadata = {
+            'event_type': event_type,
+            'events': events,
+            'insert_account_id': self.__insert_account_id,
+            'status': status_code,
+            'attempts': attempts,
+            'time': time.time()
+        }
+        try:
+            os.makedirs(self.__spool_dir, exist_ok=True)
+            # the metadata file is written last, replay only picks complete entries
+            for filename,content in [(name + '.json.gz', payload), (name + '.meta.json', json.dumps(metadata).encode('utf-8'))]:
+                with open(filename + '.tmp', 'wb') as f:
+                    f.write(content)
+                os.replace(filename + '.tmp', filename)
+            return name + '.json.gz'
+        except OSError:
+            return None
+
+    def __replay_one(self, meta_file, max_retries):
+        """posts a spooled payload and removes it once accepted, returns True if it was"""
+        name = meta_file[:-len('.meta.json')]
+        try:
+            with open(meta_file) as f:
+                metadata = json.load(f)
+            with open(name + '.json.gz', 'rb') as f:
+                payload = f.read()
+        except (OSError, ValueError):
+            msg('warning: cannot read spooled payload {}', name, stop=False)
+            return False
+        status_code, attempts = self.__send(payload, metadata.get('events', 0), max_retries)
+        if status_code != requests.codes.ok:
+            msg('warning: gave up replaying {} after {} attempts (status {})', name, attempts, status_code, stop=False)
+            return False
+        os.remove(meta_file)
+        os.remove(name + '.json.gz')
+        return True
+
+    def __submit(self, function, *args):
+        """queues a post to the workers, waits while MAX_PENDING posts are queued"""
+        self.__pending = [future for future in self.__pending if not future.done()]
+        if len(self.__pending) >= self.MAX_PENDING:
+            wait(self.__pending, return_when=FIRST_COMPLETED)
+        future = self.__executor.submit(function, *args)
+        self.__pending.append(future)
+        return future
+
+    def when_written(self, callback):
+        """calls callback once the chunks dumped so far are posted, on a post worker thread"""
+        pending = [future for future in self.__pending if not future.done()]
+        remaining = [len(pending)]
+        def done(_):
+            with self.__lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    callback()
+        if not pending:
+            with self.__lock:
+                callback()
+        for future in pending:
+            future.add_done_callback(done)
+
+    def get_run_folder(self):
+        """events are sent to Insights, there is no run folder"""
+        return None
+
     def get_accounts(self):
         """returns a list of accounts dictionaries"""
         try:
@@ -43,18 +195,17 @@ class StorageNewRelicInsights():
             return []
 
     def dump_data(self, master, event_type, data=[], max_retries=MAX_RETRIES):
-        """appends the data to the event"""
+        """appends the data to the event, the chunks are posted in the background"""
         for chunk in self.__gen_chunk(event_type, data):
-            succeeded = False
-            count_retries = 0
-            while not succeeded and count_retries < max_retries:
-                try:
-                    count_retries += 1
-                    response = requests.post(
-                        self.__url,
-                        data=json.dumps(chunk),
-                        headers=self.__headers
-                    )
-                    succeeded = (response.status_code == requests.codes.ok)
-                except:
-                    continue
\ No newline at end of file
+            self.__submit(self.__post, chunk, event_type, max_retries)
+
+    def replay(self, max_retries=MAX_RETRIES):
+        """re-sends the spooled payloads in parallel, returns how many were sent and how many were spooled"""
+        meta_files = sorted(glob.glob(os.path.join(glob.escape(self.__spool_dir), '*.meta.json')))
+        futures = [self.__submit(self.__replay_one, meta_file, max_retries) for meta_file in meta_files]
+        return sum(1 for future in futures if future.result()), len(meta_files)
+
+    def destroy(self):
+        """waits for the queued chunks to be posted"""
+        self.__executor.shutdown(wait=True)
+        self.__pending = []
@@ -0,0 +1,187 @@
+#
+# author: Paulo Monteiro
+# version: 0.1
+#
+
+import csv
+import glob
+import os
+import time
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from newrelic_query_api import Rows
+from schema_registry import SchemaRegistry
+
+
+def abort(message):
+    """abort the command"""
+    print(message)
+    exit(1)
+
+
+def from_serial_dates(values):
+    """converts Sheets / Excel serial datetimes (see to_datetime) to epoch milliseconds"""
+    EPOCH_START = 25569 # 1970-01-01 00:00:00
+    MILLISECONDS_IN_A_DAY = 86400000
+    return [None if v is None else int(round((v - EPOCH_START) * MILLISECONDS_IN_A_DAY)) for v in values]
+
+
+def get_array(values, is_date=False, field_type=None):
+    """builds a typed arrow array, datetime columns become UTC timestamps
+
+        without field_type the type is inferred, mixed types fall back to strings
+    """
+    if is_date and all(v is None or type(v) in [int, float] for v in values):
+        array = pa.array(from_serial_dates(values), type=pa.int64()).cast(pa.timestamp('ms', tz='UTC'))
+        if field_type is None or array.type == field_type:
+            return array
+    if field_type is not None:
+        return pa.array(values, type=field_type)
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+        return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+
+
+class StorageParquet():
+    """ local folder / Parquet files storage, one file per master name and query like StorageLocal
+
+        - rows are buffered per file and written as compressed row groups of ROW_GROUP_ROWS
+        - column types are inferred from the first row group, datetime columns are stored
+          as UTC timestamps
+        - a file is written as .tmp and renamed once closed, a new part file is started
+          when the query schema gets new columns, a value does not fit the file types or
+          a resumed run writes to the same name
+        - files are closed every SYNC_ROWS rows and on destroy(), only then when_written
+          callbacks run, so the journal never records rows that could still be lost
+    """
+
+    ROW_GROUP_ROWS = 65536
+    SYNC_ROWS = 1000000
+    COMPRESSION = 'zstd'
+
+    def __init__(self, account_file, output_folder, timestamp=None, prefix='RUN', run_folder=None, schemas=None, suffix=''):
+        """init, run_folder reopens the output of a previous run, suffix tells the files of a shard apart"""
+        if pa is None:
+            abort('error: the parquet storage needs pyarrow, pip install pyarrow')
+        self.__buffers = {}
+        self.__writers = {}
+        self.__callbacks = []
+        self.__unsynced = 0
+        self.__suffix = suffix
+        self.__schemas = schemas if schemas else SchemaRegistry()
+        self.__account_file = account_file
+        self.__output_folder = \
+            run_folder if run_folder else \
+            os.path.join(
+                output_folder,
+                time.strftime(
+                    f'{prefix}_%Y-%m-%d_%H-%M',
+                    time.localtime() if not timestamp else timestamp
+                )
+            )
+        # parts left open by a crashed run never got their footer, other shards may be writing theirs
+        folder = glob.escape(self.__output_folder)
+        for pattern in [f'*{suffix}.parquet.tmp', f'*{suffix}.*.parquet.tmp']:
+            for path in glob.glob(os.path.join(folder, pattern)):
+                os.remove(path)
+
+    def __get_path(self, name):
+        """returns the first free parquet part file path"""
+        name += self.__suffix
+        part, path = 0, os.path.join(self.__output_folder, name + '.parquet')
+        while os.path.exists(path):
+            part += 1
+            path = os.path.join(self.__output_folder, f'{name}.{part}.parquet')
+        return path
+
+    def __close(self, name):
+        """closes the name writer and publishes its file"""
+        writer, path, _ = self.__writers.pop(name)
+        writer.close()
+        os.replace(path + '.tmp', path)
+
+    def __sync(self):
+        """writes all buffers, closes all files and runs the pending callbacks"""
+        for name in list(self.__buffers):
+            self.__write(name)
+        for name in list(self.__writers):
+            self.__close(name)
+        callbacks, self.__callbacks, self.__unsynced = self.__callbacks, [], 0
+        for callback in callbacks:
+            callback()
+
+    def __write(self, name):
+        """writes the buffered rows of name as a row group"""
+        output_file, rows = self.__buffers.pop(name)
+        columns = self.__schemas.get_schema(output_file).columns
+        width = len(columns)
+        # rows buffered before the schema grew are shorter
+        values = list(zip(*[tuple(row) + (None,) * (width - len(row)) for row in rows]))
+        table = None
+        if name in self.__writers:
+            _, _, schema = self.__writers[name]
+            if len(schema) == width:
+                try:
+                    arrays = [get_array(list(v), 'datetime' in c, f.type) for c,v,f in zip(columns, values, schema)]
+                    table = pa.Table.from_arrays(arrays, schema=schema)
+                except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+                    table = None
+            if table is None:
+                self.__close(name)
+        if table is None:
+            arrays = [get_array(list(v), 'datetime' in c) for c,v in zip(columns, values)]
+            table = pa.Table.from_arrays(arrays, names=columns)
+            path = self.__get_path(name)
+            writer = pq.ParquetWriter(path + '.tmp', table.schema, compression=self.COMPRESSION)
+            self.__writers[name] = (writer, path, table.schema)
+        self.__writers[name][0].write_table(table)
+
+    def when_written(self, callback):
+        """calls callback once everything dumped so far is in a closed file"""
+        if not self.__buffers and not self.__writers:
+            callback()
+        else:
+            self.__callbacks.append(callback)
+            if self.__unsynced >= self.SYNC_ROWS:
+                self.__sync()
+
+    def get_run_folder(self):
+        """returns the run output folder"""
+        return self.__output_folder
+
+    def get_accounts(self):
+        """returns a list of accounts dictionaries"""
+        try:
+            with open(self.__account_file) as f:
+                csv_reader = csv.DictReader(f, delimiter=',')
+                return list(dict(row) for row in csv_reader)
+        except:
+            return []
+
+    def dump_data(self, master, output_file, data=[]):
+        """buffers the data of the output file, full row groups are written"""
+        os.makedirs(self.__output_folder, mode=0o755, exist_ok=True)
+        rows = Rows.from_data(data)
+        if not rows.header:
+            return
+        name = master + '_' + output_file
+        # all files of a query share the same union schema and columns order
+        schema = self.__schemas.get_schema(output_file, rows.header)
+        align = schema.get_aligner(rows.header)
+        _, buffer = self.__buffers.setdefault(name, (output_file, []))
+        for row in rows:
+            buffer.append(align(row))
+            self.__unsynced += 1
+            if len(buffer) >= self.ROW_GROUP_ROWS:
+                self.__write(name)
+                _, buffer = self.__buffers.setdefault(name, (output_file, []))
+
+    def destroy(self):
+        """writes the remaining rows and closes all files"""
+        self.__sync()
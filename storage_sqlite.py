@@ -0,0 +1,179 @@
+#
+# author: Paulo Monteiro
+# version: 0.1
+#
+
+import csv
+import json
+import os
+import sqlite3
+import time
+
+from newrelic_query_api import Rows
+
+
+def quote(identifier):
+    """quotes a table / column name"""
+    return '"' + str(identifier).replace('"', '""') + '"'
+
+
+def from_serial_date(value):
+    """converts a Sheets / Excel serial datetime (see to_datetime) to a SQLite UTC datetime text"""
+    EPOCH_START = 25569 # 1970-01-01 00:00:00
+    SECONDS_IN_A_DAY = 86400
+    if type(value) not in [int, float]:
+        return value
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(round((value - EPOCH_START) * SECONDS_IN_A_DAY)))
+
+
+def to_sql_value(value):
+    """lists and dicts (e.g. keyset results) are stored as JSON text"""
+    if value is None or type(value) in [int, float, str, bool]:
+        return value
+    return json.dumps(value)
+
+
+class StorageSQLite():
+    """ single SQLite database file storage, one table per query name
+
+        - tables get the columns of every master / account, new columns are added with
+          ALTER TABLE as they show up
+        - each row covers the window [timestamp - timewindow, timestamp], each dump is one
+          transaction that first deletes the rows of the same master name and account id
+          whose window is inside or overlaps the range of the new rows, and then bulk inserts
+          them, so running overlapping periods again replaces rows instead of duplicating them;
+          windows that only touch (e.g. incremental runs) are both kept
+        - tables are indexed on (master_name, account_id, timestamp) for the upsert and for
+          time range queries, datetime columns are stored as UTC 'YYYY-MM-DD HH:MM:SS' text
+        - several processes (e.g. shards) can write to the same database, a dump waits up to
+          BUSY_TIMEOUT seconds for the others
+    """
+
+    KEY_COLUMNS = ['master_name', 'account_id']
+    TIMESTAMP_COLUMN = 'timestamp'
+    TIMEWINDOW_COLUMN = 'timewindow'
+    BUSY_TIMEOUT = 300
+
+    def __init__(self, account_file, database_file):
+        """init"""
+        self.__account_file = account_file
+        self.__database_file = database_file
+        folder = os.path.dirname(database_file)
+        if folder:
+            os.makedirs(folder, mode=0o755, exist_ok=True)
+        self.__connection = sqlite3.connect(database_file, isolation_level=None, timeout=self.BUSY_TIMEOUT)
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        self.__connection.execute('PRAGMA synchronous=NORMAL')
+        self.__columns = {}
+
+    def __get_columns(self, table):
+        """returns the lower case column names of a table, empty if it does not exist"""
+        if not table in self.__columns:
+            rows = self.__connection.execute(f'PRAGMA table_info({quote(table)})').fetchall()
+            self.__columns[table] = [row[1].lower() for row in rows]
+        return self.__columns[table]
+
+    def __prepare_table(self, table, header):
+        """creates the table or adds the new header columns, then the upsert index"""
+        existing = self.__get_columns(table)
+        new_columns = [column for column in header if not column.lower() in existing]
+        if new_columns:
+            # another process may have changed the table since it was cached
+            self.__columns.pop(table, None)
+            existing = self.__get_columns(table)
+            new_columns = [column for column in header if not column.lower() in existing]
+        if not existing:
+            self.__connection.execute(f'CREATE TABLE {quote(table)} ({", ".join(quote(c) for c in new_columns)})')
+        else:
+            for column in new_columns:
+                self.__connection.execute(f'ALTER TABLE {quote(table)} ADD COLUMN {quote(column)}')
+        if new_columns:
+            self.__columns[table] = existing + [c.lower() for c in new_columns]
+            index_columns = [c for c in self.KEY_COLUMNS + [self.TIMESTAMP_COLUMN] if c in self.__columns[table]]
+            if index_columns:
+                index = quote('ix_' + table + '_' + '_'.join(index_columns))
+                self.__connection.execute(
+                    f'CREATE INDEX IF NOT EXISTS {index} ON {quote(table)} ({", ".join(quote(c) for c in index_columns)})')
+
+    def __get_window_condition(self):
+        """rows whose window is inside [start, end] or overlaps (start, end)"""
+        end = quote(self.TIMESTAMP_COLUMN)
+        start = f'({end} - {quote(self.TIMEWINDOW_COLUMN)})'
+        return f'(({start} >= ? AND {end} <= ?) OR ({start} < ? AND {end} > ?))'
+
+    def __get_deletes(self, header, values, key_idx):
+        """returns the delete parameters, the window range of the new rows per master name / account id"""
+        if not self.TIMESTAMP_COLUMN in header or not self.TIMEWINDOW_COLUMN in header:
+            return []
+        timestamp_idx = header.index(self.TIMESTAMP_COLUMN)
+        timewindow_idx = header.index(self.TIMEWINDOW_COLUMN)
+        windows = {}
+        for row in values:
+            end, timewindow = row[timestamp_idx], row[timewindow_idx]
+            if not type(end) in [int, float] or not type(timewindow) in [int, float]:
+                continue
+            key = tuple(row[idx] for idx in key_idx)
+            start = end - timewindow
+            if key in windows:
+                start, end = min(start, windows[key][0]), max(end, windows[key][1])
+            windows[key] = (start, end)
+        return [key + (start, end, end, start) for key,(start,end) in sorted(windows.items(), key=str)]
+
+    def when_written(self, callback):
+        """calls callback once everything dumped so far is written, every dump is committed"""
+        callback()
+
+    def get_run_folder(self):
+        """all runs share the same database, there is no run folder"""
+        return None
+
+    def get_accounts(self):
+        """returns a list of accounts dictionaries"""
+        try:
+            with open(self.__account_file) as f:
+                csv_reader = csv.DictReader(f, delimiter=',')
+                return list(dict(row) for row in csv_reader)
+        except:
+            return []
+
+    def dump_data(self, master, output_file, data=[]):
+        """replaces the rows of the same master / account / time window in the output_file table"""
+        rows = Rows.from_data(data)
+        # SQLite column names are case insensitive, the first spelling seen wins
+        positions = {}
+        for k,v in enumerate(rows.header):
+            positions.setdefault(v.lower(), k)
+        positions = sorted(positions.values())
+        header = [rows.header[k] for k in positions]
+        if not header:
+            return
+        dates_idx = [k for k,v in enumerate(header) if 'datetime' in v]
+        values = []
+        for row in rows:
+            row = [to_sql_value(row[k]) for k in positions]
+            for idx in dates_idx:
+                row[idx] = from_serial_date(row[idx])
+            values.append(row)
+        key_idx = [header.index(c) for c in self.KEY_COLUMNS if c in header]
+        deletes = self.__get_deletes(header, values, key_idx)
+        table = output_file
+        connection = self.__connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.__prepare_table(table, header)
+            if deletes:
+                where = ' AND '.join([f'{quote(header[idx])} IS ?' for idx in key_idx] + [self.__get_window_condition()])
+                connection.executemany(f'DELETE FROM {quote(table)} WHERE {where}', deletes)
+            placeholders = ', '.join('?' * len(header))
+            connection.executemany(
+                f'INSERT INTO {quote(table)} ({", ".join(quote(c) for c in header)}) VALUES ({placeholders})', values)
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            # the cached columns may include ones the rollback removed
+            self.__columns.pop(table, None)
+            raise
+
+    def destroy(self):
+        """closes the database"""
+        self.__connection.close()